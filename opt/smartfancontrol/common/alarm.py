@@ -7,13 +7,17 @@
 #########################################################
 
 ####################### IMPORTS #########################
-from threading import Timer, Lock, Event
+from threading import Lock
+from collections import deque
+from time import time
 from common.alarms import alarms
 
 #########################################################
 
 ####################### GLOBALS #########################
-
+HISTORYSIZE = 32
+# alarms ordered by priority, highest first
+PRIOORDER = sorted(alarms.alarmdata, key = lambda alm: -alarms.alarmdata[alm][0])
 #########################################################
 
 ###################### FUNCTIONS ########################
@@ -25,79 +29,93 @@ from common.alarms import alarms
 #########################################################
 class alarm(alarms):
     def __init__(self, delay = 5):
-        self.alarms = []
+        # active alarms as bits, readers only read the mask, writers hold the mutex
+        self.mask = 0
+        self.prio = self.ALARM_NONE
+        self.last = self.ALARM_NONE
+        self.sequence = dict.fromkeys(self.alarmdata, 0)
+        self.count = 0
+        self.history = deque(maxlen = HISTORYSIZE)
         self.delay=delay
-        self.timer = None
-        self.timerBusy = Event()
-        self.timerBusy.clear()
-        self.timerQ = Event()
-        self.timerQ.clear()
+        self.deadline = None
         self.mutex = Lock()
-    
+
     def __del__(self):
-        self.mutex.acquire()
-        if self.timerBusy and self.timer:
-            self.timer.cancel()
-        self.mutex.release()
-        del self.timerBusy
-        del self.timerQ
+        del self.history
         del self.mutex
-        del self.timer
-        del self.alarms
-    
+
     def __str__(self):
         return self.printlast()
-    
+
     def __repr__(self):
         return self.printlastshort()
-    
+
     def set(self, alm):
-        self.alarms.insert(0, alm)
-    
+        self.mutex.acquire()
+        if not self.mask & (1 << alm):
+            self.mask |= 1 << alm
+            self.history.append((time(), alm, True))
+            self._prio()
+        self.count += 1
+        self.sequence[alm] = self.count
+        self.last = alm
+        self.mutex.release()
+
     def get(self, alm):
-        return self._posAlarm(alm) >= 0
-    
+        return (self.mask >> alm) & 1 == 1
+
     def reset(self, alm):
-        posalm = self._posAlarm(alm)
-        if posalm >= 0:
-            self.alarms.pop(posalm)
-            return True
-        else:    
+        if not self.get(alm):
             return False
-    
+        self.mutex.acquire()
+        found = (self.mask >> alm) & 1 == 1
+        if found:
+            self.mask &= ~(1 << alm)
+            self.history.append((time(), alm, False))
+            self._prio()
+            if self.last == alm:
+                self.last = max(self.getall(), key = lambda other: self.sequence[other], default = self.ALARM_NONE)
+        self.mutex.release()
+        return found
+
     def resetall(self):
-        self.alarms.clear()
-    
+        self.mutex.acquire()
+        now = time()
+        for alm in self.getall():
+            self.history.append((now, alm, False))
+        self.mask = 0
+        self.prio = self.ALARM_NONE
+        self.last = self.ALARM_NONE
+        self.mutex.release()
+
     def getall(self):
-        return self.alarms
-    
+        # active alarms, last set first
+        mask = self.mask
+        active = [alm for alm in self.alarmdata if (mask >> alm) & 1]
+        return sorted(active, key = lambda alm: -self.sequence[alm])
+
     def getprio(self):
-        prio = 0
-        prioalm = 0
-        for alm in self.alarms:
-            almprio = self.alarmdata[alm][0]
-            if almprio > prio:
-                prio = almprio
-                prioalm = alm
-        return prioalm
-        
+        return self.prio
+
     def getlast(self):
-        if len(self.alarms) > 0:
-            return self.alarms[0]
-        else:
-            return 0
-    
+        return self.last
+
+    def gethistory(self):
+        # (time, alarm, active) of the latest alarm changes, oldest first
+        return list(self.history)
+
     def print(self, alm):
         return self.alarmdata[alm][2]
-    
+
     def printshort(self, alm):
         return self.alarmdata[alm][1]
-    
+
     def printall(self):
         prntall = ""
         first = True
-        if len(self.alarms)>0:
-            for alm in self.alarms:
+        active = self.getall()
+        if len(active)>0:
+            for alm in active:
                 if not first:
                     prntall += "\n"
                 prntall += self.alarmdata[alm][2]
@@ -105,60 +123,40 @@ class alarm(alarms):
         else:
             prntall = self.print(0)
         return prntall
-    
+
     def printprio(self):
         prio = self.getprio()
         return self.print(prio)
-    
+
     def printlast(self):
-        prnt = ""
-        if len(self.alarms)>0:
-            prnt = self.print(self.alarms[0])
-        else:
-            prnt = self.print(0)
-        return prnt
-    
+        return self.print(self.last)
+
     def printlastshort(self):
-        prnt = ""
-        if len(self.alarms)>0:
-            prnt = self.printshort(self.alarms[0])
-        else:
-            prnt = self.printshort(0)
-        return prnt
-    
-    def _posAlarm(self, alm):
-        PosAlm = -1
-        try:
-            PosAlm = self.alarms.index(alm)
-        except:
-            pass
-        return PosAlm
-    
+        return self.printshort(self.last)
+
+    def _prio(self):
+        # highest priority active alarm, only determined when the alarms change
+        prio = self.ALARM_NONE
+        for alm in PRIOORDER:
+            if (self.mask >> alm) & 1:
+                prio = alm
+                break
+        self.prio = prio
+
     def timerGet(self):
-        self.mutex.acquire()
-        if not self.timerBusy.isSet() and not self.timer:
-            self.timer = Timer(self.delay, self._timercallback)
-            self.timer.start()
-            self.timerBusy.set()
-            self.timerQ.clear()
-        self.mutex.release()
-        return self.timerQ.isSet()
-    
+        """Returns whether the alarm condition lasted for delay seconds since the first call after a reset.
+        The delay is a deadline checked by the caller, no timer thread is started.
+        """
+        now = time()
+        if self.deadline == None:
+            self.deadline = now + self.delay
+        return now >= self.deadline
+
     def timerClear(self):
-        self.mutex.acquire()
-        if self.timerBusy.isSet() and self.timer:
-            self.timer.cancel()
-            self.timer = None
-        self.timerBusy.clear()
-        self.timerQ.clear()
-        self.mutex.release()
-    
+        self.deadline = None
+
     def timerReset(self):
-        if self.timerBusy.isSet():
-            self.timerClear()
-        
-    def _timercallback(self):
-        self.timerQ.set()
+        self.timerClear()
 
 ######################### MAIN ##########################
 if __name__ == "__main__":
@@ -19,6 +19,7 @@ class alarms:
     ALARM_FANNOTMAXRPM  = 5
     ALARM_FANNORPMMODE  = 6
     ALARM_FANCALSTALL   = 7
+    ALARM_TEMPRISE      = 8
 
     #alarmdata: prio, short_string, long_string
     alarmdata = {ALARM_NONE          : (  0,"Ok"              ,"No Alarm"),
@@ -28,7 +29,8 @@ class alarms:
                  ALARM_FANNOTRUNNING : ( 70,"Fan stalled"     ,"Fan is not running/ stalled"),
                  ALARM_FANNOTMAXRPM  : ( 50,"Fan low RPM"     ,"Fan cannot reach maximum RPM"),
                  ALARM_FANNORPMMODE  : ( 10,"Fan No RPM"      ,"Fan alarm monitoring only possible in RPM mode"),
-                 ALARM_FANCALSTALL   : ( 60,"Fan stalled cal" ,"Fan is not running/ stalled during calibration")}
+                 ALARM_FANCALSTALL   : ( 60,"Fan stalled cal" ,"Fan is not running/ stalled during calibration"),
+                 ALARM_TEMPRISE      : ( 95,"Temp rising"     ,"Temperature rises too fast")}
 
 ######################### MAIN ##########################
 if __name__ == "__main__":
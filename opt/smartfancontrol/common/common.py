@@ -86,6 +86,26 @@ class common(object):
         return retval
     
     
+    def parseperiod(self, text):
+        # Time of the day HH:MM-HH:MM as (start, end) in minutes of the day
+        minutes = []
+        for clock in str(text).split("-"):
+            hours, mins = clock.strip().split(":")
+            value = int(hours) * 60 + int(mins)
+            if value < 0 or value >= 24 * 60:
+                raise ValueError("Invalid time: {}".format(clock))
+            minutes.append(value)
+        if len(minutes) != 2:
+            raise ValueError("Invalid time of the day: {}".format(text))
+        return minutes[0], minutes[1]
+    
+    def inperiod(self, period, minute):
+        # Whether minute of the day is within period (start, end), the period may pass midnight
+        start, end = period
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+    
     def loge(self, txt):
         if self.logger:
             self.logger.error(txt)
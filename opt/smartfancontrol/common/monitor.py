@@ -15,6 +15,8 @@ import os
 ####################### GLOBALS #########################
 UPDATEFREQ = 1
 RUNFILE = "/run/smartfancontrol"
+METRICSFILE = "/run/smartfancontrol.metrics"
+METRICSPREFIX = "smartfancontrol_"
 #########################################################
 
 ###################### FUNCTIONS ########################
@@ -36,12 +38,17 @@ class monitor(Thread):
         self.mutex = mutex
         self.monstatus = monstatus
         self.monok = self.monCheck()
+        self.providers = []
         Thread.__init__(self)
         Thread.start(self)
     
     def __del__(self):
         pass
     
+    def addmetrics(self, provider):
+        # provider.metrics() returns a list of (name, value)
+        self.providers.append(provider)
+
     def start(self):
         self.runthread.set()
         
@@ -78,6 +85,13 @@ class monitor(Thread):
             filestr = "{!r}, {!r}, {!r}\n".format(self.temp, self.fanctrl, self.alarm)
             with open(RUNFILE, 'w') as monfile:
                 monfile.write(filestr)
+            if self.providers:
+                metricsstr = ""
+                for provider in self.providers:
+                    for name, value in provider.metrics():
+                        metricsstr += "{}{} {}\n".format(METRICSPREFIX, name, value)
+                with open(METRICSFILE, 'w') as metricsfile:
+                    metricsfile.write(metricsstr)
 
 ######################### MAIN ##########################
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : server.py                                   #
+#           Local command socket for smartfancontrol    #
+#           (one command per line, one reply per line)  #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from common.common import common
+from threading import Thread
+import selectors
+import socket
+import os
+#########################################################
+
+####################### GLOBALS #########################
+SELECT_SLEEP = 1
+RECVSIZE = 1024
+MAXLINE = 4096
+SOCKETMODE = 0o660
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : server                                        #
+#########################################################
+class server(Thread, common):
+    def __init__(self, path, logger, exitevent):
+        self.path = path
+        self.logger = logger
+        self.exitevent = exitevent
+        common.__init__(self, self.logger)
+        self.handlers = {}
+        self.selector = selectors.DefaultSelector()
+        self.sock = None
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            os.chmod(self.path, SOCKETMODE)
+            self.sock.listen()
+            self.sock.setblocking(False)
+            self.selector.register(self.sock, selectors.EVENT_READ, None)
+        except Exception as e:
+            self.loge("Error opening command socket {}: {}".format(self.path, e))
+            self.sock = None
+        self.register("help", self._help)
+        Thread.__init__(self)
+        Thread.start(self)
+
+    def __del__(self):
+        pass
+
+    def register(self, command, handler):
+        """handler(args) is called with the list of arguments and returns the reply string.
+        Handlers run in the server thread and should return immediately.
+        """
+        self.handlers[command.lower()] = handler
+
+    def run(self):
+        try:
+            while not self.exitevent.is_set() and self.sock:
+                for key, mask in self.selector.select(SELECT_SLEEP):
+                    if key.data == None:
+                        self._accept()
+                    else:
+                        self._receive(key)
+            self._close()
+        except Exception as e:
+            self.logger.exception(e)
+
+    def _accept(self):
+        conn, addr = self.sock.accept()
+        conn.setblocking(False)
+        self.selector.register(conn, selectors.EVENT_READ, bytearray())
+
+    def _receive(self, key):
+        conn = key.fileobj
+        buffer = key.data
+        try:
+            data = conn.recv(RECVSIZE)
+        except OSError:
+            data = b""
+        if not data:
+            self._disconnect(conn)
+            return
+        buffer += data
+        while b"\n" in buffer:
+            line, sep, rest = bytes(buffer).partition(b"\n")
+            buffer[:] = rest
+            reply = self._command(line.decode("utf-8", "replace"))
+            try:
+                conn.sendall((reply + "\n").encode("utf-8"))
+            except OSError:
+                self._disconnect(conn)
+                return
+        if len(buffer) > MAXLINE:
+            self._disconnect(conn)
+
+    def _command(self, line):
+        args = line.split()
+        if not args:
+            return ""
+        command = args[0].lower()
+        if not command in self.handlers:
+            return "ERROR unknown command: {}".format(args[0])
+        try:
+            return self.handlers[command](args[1:])
+        except Exception as e:
+            return "ERROR {}".format(e)
+
+    def _help(self, args):
+        return " ".join(sorted(self.handlers.keys()))
+
+    def _disconnect(self, conn):
+        self.selector.unregister(conn)
+        conn.close()
+
+    def _close(self):
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+        self.selector.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
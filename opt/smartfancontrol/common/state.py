@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : state.py                                    #
+#           Persistent state for smartfancontrol that   #
+#           survives daemon restarts                    #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import json
+from hashlib import sha1
+from threading import Lock
+from common.common import common
+#########################################################
+
+####################### GLOBALS #########################
+STATE_PATH     = "/var/lib/smartfancontrol"
+STATE_FILENAME = "smartfancontrol.state"
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : state                                         #
+#########################################################
+class state(common):
+    def __init__(self, logger = None):
+        self.logger = logger
+        common.__init__(self, self.logger)
+        self.mutex = Lock()
+        self.statepath = self.getStatepath()
+        self.data = self._read()
+
+    def __del__(self):
+        pass
+
+    def get(self, group):
+        self.mutex.acquire()
+        retval = None
+        if group in self.data:
+            retval = dict(self.data[group])
+        self.mutex.release()
+        return retval
+
+    def set(self, group, values):
+        self.mutex.acquire()
+        self.data[group] = dict(values)
+        self._write()
+        self.mutex.release()
+
+    def reset(self, group):
+        self.mutex.acquire()
+        if group in self.data:
+            del self.data[group]
+            self._write()
+        self.mutex.release()
+
+    def fingerprint(self, settings, group, keys):
+        values = []
+        for key in keys:
+            values.append(self.settype(self.checkkey(settings, group, key)))
+        return sha1("|".join(values).encode("utf-8")).hexdigest()
+
+    def getStatepath(self):
+        StatePath = ""
+        # first look in state path
+        try:
+            if not os.path.exists(STATE_PATH):
+                os.makedirs(STATE_PATH)
+            if os.access(STATE_PATH, os.W_OK):
+                StatePath = os.path.join(STATE_PATH, STATE_FILENAME)
+        except:
+            pass
+        if not StatePath:
+            # then look in home folder
+            if os.access(os.path.expanduser('~'), os.W_OK):
+                StatePath = os.path.join(os.path.expanduser('~'), "." + STATE_FILENAME)
+            else:
+                self.logw("No write access to state file, state is not kept between restarts")
+        return StatePath
+
+    def _read(self):
+        data = {}
+        if self.statepath and os.path.isfile(self.statepath):
+            try:
+                with open(self.statepath, "r") as statefile:
+                    data = json.load(statefile)
+                if type(data) != dict:
+                    data = {}
+            except:
+                self.logw("Error reading state file, state is reset")
+                data = {}
+        return data
+
+    def _write(self):
+        if self.statepath:
+            try:
+                tmppath = self.statepath + ".tmp"
+                with open(tmppath, "w") as statefile:
+                    json.dump(self.data, statefile)
+                os.replace(tmppath, self.statepath)
+            except:
+                self.logw("Error writing state file")
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -8,9 +8,11 @@
 
 ####################### IMPORTS #########################
 from time import time
-from math import pow, sqrt
+from math import pow, sqrt, pi
+from array import array
 from common.common import common
 from common.stdin import stdin
+from control.fopdt import fopdt
 #########################################################
 
 ####################### GLOBALS #########################
@@ -18,6 +20,14 @@ STEP_SLEEP  = 0.01
 LIN_SLEEP   = 5
 STEP_LENGTH = 5
 GAINMAX     = 1000
+RELAY_SLEEP     = 0.01
+RELAY_AMPLITUDE = 20 # PWM [%] around bias
+RELAY_HYST      = 0.02 # part of setpoint RPM
+RELAY_CYCLES    = 4
+RELAY_TIMEOUT   = 60
+TUNE_RELAY  = 0
+TUNE_STEP   = 1
+TUNE_MANUAL = 2
 #########################################################
 
 ###################### FUNCTIONS ########################
@@ -50,20 +60,23 @@ class autotune(common):
         print("Measuring fan step response (PWM = {:.2f}%)".format(value))
         self.fanctrl.fanoutput.set(0)
         self.fanctrl.exitevent.wait(2*LIN_SLEEP)
-        tm = []
-        rpm = []
+        # preallocated, no appending while sampling
+        size = int(STEP_LENGTH/STEP_SLEEP) + 1
+        tm = array('d', [0.0]) * size
+        rpm = array('d', [0.0]) * size
+        n = 0
         self.fanctrl.fanoutput.set(value)
         starttime = time()
         nowtime = starttime
-        while nowtime-starttime <= STEP_LENGTH and not self.fanctrl.exitevent.is_set():
+        while nowtime-starttime <= STEP_LENGTH and n < size and not self.fanctrl.exitevent.is_set():
             self.fanctrl.exitevent.wait(STEP_SLEEP)
             nowtime = time()
-            nowrpm = self.fanctrl.rpm.get()
-            tm.append(nowtime-starttime)
-            rpm.append(nowrpm)
+            tm[n] = nowtime-starttime
+            rpm[n] = self.fanctrl.rpm.get()
+            n += 1
         self.fanctrl.fanoutput.set(0)
         print("Finished measuring fan step response")
-        return (tm, rpm)
+        return (tm[:n], rpm[:n])
     
     def plotstep(self, sr):
         print("Fan step response plot")
@@ -93,44 +106,93 @@ class autotune(common):
         print("Finished fan linear plot")
         return
     
-    def calcparams(self, sr, sp):
-        if len(sr[1]) > 0:
-            maxval = max(sr[1])
-            if sp > 0:
-                Kpl = maxval/sp
-            else:
-                Kpl = 1
-            max063 = 0.63*maxval
-            #print("Max:",maxval,", Kpl:",Kpl,", max063:", max063)
-            if len(sr[0]) > 0:
-                tv = sr[0][[ n for n,i in enumerate(sr[1]) if i > 10][0]]
-                t063 = sr[0][[ n for n,i in enumerate(sr[1]) if i >= max063][0]]
-            else:
-                tv = 1
-                t063 = 2
-            t = t063 - tv
-            #print("tv:",tv,", t063:",t063, ",t:",t)
-            if tv > 0:
-                Ktot = 0.9 * t / tv
-            else:
-                Ktot = 0
-            if Kpl > 0:
-                Kp = Ktot / Kpl
-            else:
-                Kp = 0
-            ti = 3.3 * tv
+    def measurerelay(self, sp = None):
+        """Relay feedback (Astrom-Hagglund) experiment around a RPM setpoint.
+        Returns the ultimate gain and ultimate period, or None if no stable oscillation is found.
+        """
+        minrpm = self.fanctrl.min()
+        maxrpm = self.fanctrl.max()
+        if maxrpm <= 0:
+            print("Fan not calibrated, relay autotuning not possible")
+            return None
+        if sp == None:
+            sp = (minrpm + maxrpm) / 2
+        bias = self.fanctrl.calibrate.characteristic.getpwm(sp)
+        if bias <= 0:
+            bias = 50.0
+        d = min(RELAY_AMPLITUDE, bias, 100.0 - bias)
+        eps = RELAY_HYST * sp
+        print("Measuring fan relay response (RPM = {:.2f}, PWM = {:.2f}% +/- {:.2f}%)".format(sp, bias, d))
+        self.fanctrl.fanoutput.set(bias)
+        self.fanctrl.exitevent.wait(LIN_SLEEP)
+
+        high = True
+        self.fanctrl.fanoutput.set(bias + d)
+        switches = []
+        amplitudes = []
+        nowrpm = self.fanctrl.rpm.get()
+        rpmmax = nowrpm
+        rpmmin = nowrpm
+        starttime = time()
+        nowtime = starttime
+        while len(switches) < RELAY_CYCLES+2 and nowtime - starttime <= RELAY_TIMEOUT and not self.fanctrl.exitevent.is_set():
+            self.fanctrl.exitevent.wait(RELAY_SLEEP)
+            nowtime = time()
+            nowrpm = self.fanctrl.rpm.get()
+            rpmmax = max(rpmmax, nowrpm)
+            rpmmin = min(rpmmin, nowrpm)
+            if high and nowrpm > sp + eps:
+                # a new cycle starts at every switch from high to low
+                high = False
+                self.fanctrl.fanoutput.set(bias - d)
+                switches.append(nowtime)
+                amplitudes.append((rpmmax - rpmmin) / 2)
+                rpmmax = nowrpm
+                rpmmin = nowrpm
+            elif not high and nowrpm < sp - eps:
+                high = True
+                self.fanctrl.fanoutput.set(bias + d)
+        self.fanctrl.fanoutput.set(0)
+        print("Finished measuring fan relay response")
+
+        if len(switches) < RELAY_CYCLES+2:
+            print("No stable oscillation found")
+            return None
+        # Skip the first cycle, it still contains the transient from the bias point
+        Pu = (switches[-1] - switches[1]) / (len(switches) - 2)
+        a = sum(amplitudes[2:]) / len(amplitudes[2:])
+        if a <= eps:
+            print("Oscillation amplitude too small")
+            return None
+        Ku = 4 * d / (pi * sqrt(a*a - eps*eps))
+        print("Ultimate gain = {:.5f}, ultimate period = {:.3f} s".format(Ku, Pu))
+        return (Ku, Pu)
+
+    def calcrelayparams(self, ku):
+        # Tyreus-Luyben PI rules, less aggressive than Ziegler-Nichols for a noisy tacho signal
+        if ku:
+            Kp = ku[0] / 3.2
+            ti = 2.2 * ku[1]
             if ti > 0:
                 Ki = Kp / ti
             else:
                 Ki = 0
-            #print("Ktot:",Ktot,", Kp:",Kp,", ti:",ti,", Ki:", Ki)
         else:
             Kp = 0
             Ki = 0
-        
         return Kp, Ki
-    
-    
+
+    def calcparams(self, sr, sp):
+        # Least squares fit of a first order plus dead time model, PI parameters from SIMC rules
+        model = fopdt()
+        K, tau, deadtime, residual = model.fit(sr[0], sr[1], sp, 0.0)
+        if model.valid():
+            print("Model: gain = {:.3f} RPM/%, time constant = {:.3f} s, dead time = {:.3f} s, residual = {:.2f} RPM".format(K, tau, deadtime, residual))
+        Kp, Ki = model.tunePI()
+        del model
+        return Kp, Ki
+
+
     #calc mean square error
     #1. r = nowrpm - value
     #2. r^2
@@ -172,17 +234,21 @@ class autotune(common):
         print("Finished test PID parameters")
         return perc
     
-    def tune(self):
+    def tune(self, interactive = True):
+        if not interactive:
+            return self._tuneNonInteractive()
         sp = 50
         exit = False
         Ok = False
         ans = 'n'
-        auto = True
+        method = TUNE_RELAY
         stdinput = stdin("", exitevent = self.fanctrl.exitevent)
         while not exit and not self.fanctrl.exitevent.is_set():
             correctResults = False
             while not correctResults and not self.fanctrl.exitevent.is_set():
-                if auto:
+                if method == TUNE_RELAY:
+                    Kp, Ki = self.calcrelayparams(self.measurerelay())
+                elif method == TUNE_STEP:
                     Kp = 0
                     Ki = 0
                     sr = self.measurestep(sp)
@@ -204,7 +270,7 @@ class autotune(common):
             else:
                 exit = True
             if not exit and not self.fanctrl.exitevent.is_set():
-                auto, Kp, Ki, sp = self._tuneMenu(stdinput, Kp, Ki, sp)
+                method, Kp, Ki, sp = self._tuneMenu(stdinput, method, Kp, Ki, sp)
         if not self.fanctrl.exitevent.is_set():
             ans = 'Y' if Ok else 'n'
             Ok = stdinput.yn_choice("Store results?", ans)
@@ -215,14 +281,29 @@ class autotune(common):
             Ki = 0
         return Ok, round(Kp, 3), round(Ki, 3)
     
-    def _tuneMenu(self, stdinput, Kp, Ki, sp):
-        auto = True
+    def _tuneNonInteractive(self):
+        Kp, Ki = self.calcrelayparams(self.measurerelay())
+        print("Results: Pgain = {:.3f}, Igain = {:.3f}".format(Kp, Ki))
+        Ok = Kp > 0 and Kp <= GAINMAX and Ki > 0 and Ki <= GAINMAX and not self.fanctrl.exitevent.is_set()
+        if not Ok:
+            print("Incorrect autotuning results, results not stored")
+            Kp = 0
+            Ki = 0
+        return Ok, round(Kp, 3), round(Ki, 3)
+
+    def _tuneMenu(self, stdinput, method, Kp, Ki, sp):
+        if method == TUNE_MANUAL:
+            method = TUNE_RELAY
         print("Enter option:")
-        print("1: autotune again with current setpoint")
-        print("2: change PWM setpoint and autotune (PWM = {:.2f}%)".format(sp))
+        print("1: autotune again")
+        print("2: change PWM setpoint and autotune with step response (PWM = {:.2f}%)".format(sp))
         print("3: change parameters and test (Pgain = {:.3f}, Igain = {:.3f})".format(Kp, Ki))
-        choice = stdinput.inputchar("Enter choice: (1/2/3)")
-        if choice == '2':
+        print("4: autotune with relay feedback")
+        choice = stdinput.inputchar("Enter choice: (1/2/3/4)")
+        if choice == '4':
+            method = TUNE_RELAY
+        elif choice == '2':
+            method = TUNE_STEP
             inp = stdinput.input("Enter new PWM setpoint: ")
             if inp:
                 value = self.gettype(inp, False)
@@ -237,7 +318,7 @@ class autotune(common):
                 value = self.gettype(inp, False)
                 if value != None:
                     Kp = value
-                    auto = False
+                    method = TUNE_MANUAL
                 else:
                     print("Invalid input, keep current value!")
             inp = stdinput.input("Enter new Igain: ")
@@ -245,10 +326,10 @@ class autotune(common):
                 value = self.gettype(inp, False)
                 if value != None:
                     Ki = value
-                    auto = False
+                    method = TUNE_MANUAL
                 else:
                     print("Invalid input, keep current value!")
-        return auto, Kp, Ki, sp
+        return method, Kp, Ki, sp
                             
 ######################### MAIN ##########################
 if __name__ == "__main__":
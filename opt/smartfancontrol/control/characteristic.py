@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : characteristic.py                           #
+#           Lookup table of a measured PWM to RPM       #
+#           characteristic and its inverse              #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from bisect import bisect_left
+#########################################################
+
+####################### GLOBALS #########################
+
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : characteristic                                #
+#########################################################
+class characteristic(object):
+    def __init__(self):
+        self.clear()
+
+    def __del__(self):
+        pass
+
+    def clear(self):
+        #Clears the lookup table
+        self.pwms = []
+        self.rpms = []
+        self.startindex = 0
+
+    def updateSettings(self, pwms = [], rpms = []):
+        """The measured characteristic as lists of PWM values and RPM values, sorted by PWM.
+        The RPM values are made monotonic, so the characteristic can be inverted.
+        """
+        self.clear()
+        points = sorted(zip(pwms, rpms))
+        maxrpm = 0.0
+        for pwmval, rpmval in points:
+            if rpmval < maxrpm:
+                rpmval = maxrpm
+            maxrpm = rpmval
+            self.pwms.append(float(pwmval))
+            self.rpms.append(float(rpmval))
+        """First point where the fan is running, below this point the inverse is undefined"""
+        while self.startindex < len(self.rpms) and self.rpms[self.startindex] <= 0:
+            self.startindex += 1
+
+    def valid(self):
+        return len(self.rpms) - self.startindex >= 2
+
+    def getpwm(self, rpm):
+        """Returns the PWM value required for the given RPM (inverse characteristic)
+        """
+        pwm = 0.0
+        if rpm > 0 and self.valid():
+            if rpm <= self.rpms[self.startindex]:
+                pwm = self.pwms[self.startindex]
+            elif rpm >= self.rpms[-1]:
+                pwm = self.pwms[-1]
+            else:
+                i = bisect_left(self.rpms, rpm, self.startindex)
+                drpm = self.rpms[i] - self.rpms[i-1]
+                if drpm > 0:
+                    pwm = self.pwms[i-1] + (self.pwms[i] - self.pwms[i-1]) * (rpm - self.rpms[i-1]) / drpm
+                else:
+                    pwm = self.pwms[i]
+        return pwm
+
+    def getrpm(self, pwm):
+        """Returns the expected RPM for the given PWM value (characteristic)
+        """
+        rpm = 0.0
+        if self.valid():
+            if pwm >= self.pwms[-1]:
+                rpm = self.rpms[-1]
+            elif pwm > self.pwms[0]:
+                i = bisect_left(self.pwms, pwm)
+                rpm = self.rpms[i-1] + (self.rpms[i] - self.rpms[i-1]) * (pwm - self.pwms[i-1]) / (self.pwms[i] - self.pwms[i-1])
+            else:
+                rpm = self.rpms[0]
+        return rpm
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : curve.py                                    #
+#           Implements a fan curve control loop from a  #
+#           precomputed lookup table                    #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from time import time
+#########################################################
+
+####################### GLOBALS #########################
+RESOLUTION = 0.1 # table resolution in degrees
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : curve                                         #
+#########################################################
+class curve(object):
+    def __init__(self):
+        self.sample_time = 1.0
+        self.outputmin = 0.0
+        self.outputmax = 100.0
+        self.points = []
+        self.fallpoints = []
+
+        self.compile()
+
+    def __del__(self):
+        pass
+
+    def clear(self):
+        #Clears computations
+        self.output = 0.0
+
+        self.current_time = time()
+        self.last_time = self.current_time
+
+        return self.output
+
+    def parse(self, text):
+        """Parses a curve in the format 'temperature:output,temperature:output,...'.
+        Output is in % of the fan range, 0 is off. Raises ValueError on a malformed curve.
+        """
+        points = []
+        if text != None:
+            for point in str(text).replace(";", ",").split(","):
+                if point.strip():
+                    tempval, outval = point.split(":")
+                    points.append((float(tempval), float(outval)))
+        if len(points) < 1:
+            raise ValueError("Empty curve")
+        points.sort()
+        return points
+
+    def updateSettings(self, frequency = 1.0, outputmin = 0.0, outputmax = 100.0, points = [], fallpoints = []):
+        """Curve control that should be updated at a regular interval.
+        Based on a pre-determined sample time, the controller decides if it should compute or return immediately.
+        """
+        self.sample_time = 1/frequency
+        """Determines the output at 0+% (minimum output if switched on)"""
+        self.outputmin = outputmin
+        """Determines the output at 100%"""
+        self.outputmax = outputmax
+        """The curve used when the temperature rises, list of (temperature, %)"""
+        self.points = sorted(points)
+        """The curve used when the temperature falls (hysteresis), if empty the rising curve is used"""
+        self.fallpoints = sorted(fallpoints)
+
+        self.compile()
+
+    def compile(self):
+        # Precompute dense tables, so an update is a single index lookup
+        allpoints = self.points + self.fallpoints
+        if allpoints:
+            self.tempmin = min(allpoints)[0]
+            tempmax = max(allpoints)[0]
+        else:
+            self.tempmin = 0.0
+            tempmax = 0.0
+        self.size = int(round((tempmax - self.tempmin) / RESOLUTION)) + 1
+        self.risetable = self._table(self.points)
+        if self.fallpoints:
+            self.falltable = self._table(self.fallpoints)
+        else:
+            self.falltable = self.risetable
+        self.clear()
+
+    def update(self, feedback_value, current_time=None):
+        """Calculates curve value for given reference feedback
+        """
+
+        self.current_time = current_time if current_time is not None else time()
+        delta_time = self.current_time - self.last_time
+
+        if delta_time >= self.sample_time:
+            index = int((feedback_value - self.tempmin) / RESOLUTION + 0.5)
+            if index < 0:
+                index = 0
+            elif index >= self.size:
+                index = self.size - 1
+            rise = self.risetable[index]
+            fall = self.falltable[index]
+            if rise > self.output:
+                self.output = rise
+            elif fall < self.output:
+                self.output = fall
+            # else hold output between falling and rising curve
+
+        return self.output
+
+    def _table(self, points):
+        table = [0.0] * self.size
+        if points:
+            p = 0
+            for i in range(self.size):
+                tempval = self.tempmin + i * RESOLUTION
+                while p < len(points) - 1 and points[p+1][0] <= tempval:
+                    p += 1
+                if tempval <= points[0][0]:
+                    perc = points[0][1]
+                elif p >= len(points) - 1:
+                    perc = points[-1][1]
+                else:
+                    t0, o0 = points[p]
+                    t1, o1 = points[p+1]
+                    perc = o0 + (o1 - o0) * (tempval - t0) / (t1 - t0)
+                table[i] = self._output(perc)
+        return table
+
+    def _output(self, perc):
+        if perc <= 0:
+            return 0.0
+        if perc > 100.0:
+            perc = 100.0
+        return self.outputmin + (self.outputmax - self.outputmin) * perc / 100.0
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
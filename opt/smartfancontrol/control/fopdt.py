@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : fopdt.py                                    #
+#           First order plus dead time model fit on a   #
+#           step response and PI tuning from the model  #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from math import exp, log
+#########################################################
+
+####################### GLOBALS #########################
+STEADYPART  = 0.2  # last part of the response used as steady state
+FITLOW      = 0.05 # normalized response range used for the time constant fit
+FITHIGH     = 0.9
+DEADMAX     = 0.5  # dead time is searched until the response reaches this normalized level
+CANDIDATES  = 50
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : fopdt                                         #
+#########################################################
+class fopdt(object):
+    def __init__(self):
+        self.clear()
+
+    def __del__(self):
+        pass
+
+    def clear(self):
+        #Clears the model
+        self.gain = 0.0
+        self.tau = 0.0
+        self.deadtime = 0.0
+        self.residual = 0.0
+
+    def valid(self):
+        return self.gain != 0.0 and self.tau > 0.0
+
+    def fit(self, tm, y, step, y0 = None):
+        """Least squares fit of a first order plus dead time model on a step response:
+        y(t) = y0 + K * step * (1 - exp(-(t - deadtime) / tau)) for t > deadtime, y0 before.
+        tm and y are equally sized sequences, step is the size of the input step at tm = 0.
+        Returns gain, time constant, dead time and the RMS fit residual.
+        """
+        self.clear()
+        n = len(y)
+        if n < 10 or step == 0:
+            return self.gain, self.tau, self.deadtime, self.residual
+        if y0 == None:
+            y0 = y[0]
+        nss = max(int(n * STEADYPART), 1)
+        yss = sum(y[n-nss:]) / nss
+        dy = yss - y0
+        if dy == 0:
+            return self.gain, self.tau, self.deadtime, self.residual
+
+        # Normalized response, dead time candidates until the response is halfway
+        r = [(yi - y0) / dy for yi in y]
+        last = 0
+        while last < n-1 and r[last] < DEADMAX:
+            last += 1
+        stride = max(last // CANDIDATES, 1)
+
+        best = None
+        for c in range(0, last + 1, stride):
+            theta = tm[c]
+            # Linear least squares through the origin of -ln(1-r) = (t-theta)/tau
+            sxz = 0.0
+            sxx = 0.0
+            for i in range(c, n):
+                if r[i] > FITLOW and r[i] < FITHIGH:
+                    x = tm[i] - theta
+                    sxz += x * -log(1.0 - r[i])
+                    sxx += x * x
+            if sxz <= 0.0:
+                continue
+            tau = sxx / sxz
+            sse = 0.0
+            for i in range(n):
+                if tm[i] > theta:
+                    e = r[i] - 1.0 + exp(-(tm[i] - theta) / tau)
+                else:
+                    e = r[i]
+                sse += e * e
+            if best == None or sse < best[0]:
+                best = (sse, tau, theta)
+
+        if best:
+            self.gain = dy / step
+            self.tau = best[1]
+            self.deadtime = best[2]
+            self.residual = abs(dy) * (best[0] / n) ** 0.5
+        return self.gain, self.tau, self.deadtime, self.residual
+
+    def tunePI(self, tc = None):
+        """PI parameters from the model (SIMC rules), tc is the desired closed loop time constant.
+        Default tc is the dead time (tight control), but not smaller than 10% of the time constant.
+        Returns Kp and Ki for a positive error sign, the caller handles the sign of the process gain.
+        """
+        Kp = 0.0
+        Ki = 0.0
+        if self.valid():
+            if tc == None:
+                tc = max(self.deadtime, 0.1 * self.tau)
+            Kp = self.tau / (abs(self.gain) * (tc + self.deadtime))
+            ti = min(self.tau, 4 * (tc + self.deadtime))
+            if ti > 0:
+                Ki = Kp / ti
+        return Kp, Ki
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : leases.py                                   #
+#           Temporary fan boosts and temperature target #
+#           caps requested by external workloads        #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from time import time
+from threading import Lock
+import heapq
+from math import isfinite
+#########################################################
+
+####################### GLOBALS #########################
+LEASE_BOOST = "boost"
+LEASE_CAP   = "cap"
+MAXLEASES   = 64
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : leases                                        #
+#########################################################
+class leases(object):
+    def __init__(self):
+        # heap of (expires, id, kind, value), the first lease expires first
+        self.heap = []
+        self.mutex = Lock()
+        self.nextid = 1
+        self.clear()
+
+    def __del__(self):
+        pass
+
+    def clear(self):
+        #Removes all leases
+        self.mutex.acquire()
+        self.heap = []
+        self.boost = None
+        self.cap = None
+        self.mutex.release()
+
+    def add(self, kind, value, duration, current_time = None):
+        """Adds a lease of kind LEASE_BOOST (minimum fan output) or LEASE_CAP (maximum temperature target)
+        for duration seconds, returns the lease id or 0 if there are too many leases.
+        A duration or value that is not finite is not ordered in the heap and raises ValueError.
+        """
+        if not isfinite(duration) or duration <= 0 or not isfinite(value):
+            raise ValueError("invalid lease: {} {} for {} s".format(kind, value, duration))
+        now = current_time if current_time is not None else time()
+        self.mutex.acquire()
+        leaseid = 0
+        if len(self.heap) < MAXLEASES:
+            leaseid = self.nextid
+            self.nextid += 1
+            heapq.heappush(self.heap, (now + duration, leaseid, kind, value))
+            self._merge()
+        self.mutex.release()
+        return leaseid
+
+    def remove(self, leaseid):
+        """Ends a lease before it expires, returns whether the lease existed"""
+        self.mutex.acquire()
+        count = len(self.heap)
+        self.heap = [lease for lease in self.heap if lease[1] != leaseid]
+        found = len(self.heap) < count
+        if found:
+            heapq.heapify(self.heap)
+            self._merge()
+        self.mutex.release()
+        return found
+
+    def update(self, current_time = None):
+        """Returns the merged (boost, cap) of the active leases, None if there is no lease of that kind.
+        Only the first expiry is compared, leases are only merged again when a lease is added, removed or expired.
+        """
+        now = current_time if current_time is not None else time()
+        self.mutex.acquire()
+        if self.heap and self.heap[0][0] <= now:
+            while self.heap and self.heap[0][0] <= now:
+                heapq.heappop(self.heap)
+            self._merge()
+        boost = self.boost
+        cap = self.cap
+        self.mutex.release()
+        return boost, cap
+
+    def getall(self, current_time = None):
+        """Active leases as (id, kind, value, seconds left), in order of expiry"""
+        now = current_time if current_time is not None else time()
+        self.mutex.acquire()
+        active = [(leaseid, kind, value, max(expires - now, 0.0)) for expires, leaseid, kind, value in sorted(self.heap)]
+        self.mutex.release()
+        return active
+
+    def _merge(self):
+        # Highest boost and lowest cap of all leases
+        self.boost = None
+        self.cap = None
+        for expires, leaseid, kind, value in self.heap:
+            if kind == LEASE_BOOST:
+                if self.boost == None or value > self.boost:
+                    self.boost = value
+            elif self.cap == None or value < self.cap:
+                self.cap = value
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -65,6 +65,13 @@ class linear(object):
         self.linsteps = linsteps
         
         self.clear()
+    
+    def updateCommand(self, startval = 40.0, fullval = 60.0):
+        """Changes the linear range while running, the output is kept"""
+        self.startval = startval
+        self.fullval = fullval
+        self.range = self.fullval - self.startval
+        self.rc = (self.outputmax - self.outputmin) / self.range
         
     def update(self, feedback_value, current_time=None):
         """Calculates linear value for given reference feedback
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : mpc.py                                      #
+#           Implements a model predictive control loop  #
+#           on a first order plus dead time model       #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from time import time
+from math import exp
+from collections import deque
+#########################################################
+
+####################### GLOBALS #########################
+
+#########################################################
+
+###################### FUNCTIONS ########################
+
+def _solve(matrix, rhs):
+    # Gauss-Jordan elimination with partial pivoting, solves matrix * x = rhs (rhs is a list of columns)
+    n = len(matrix)
+    a = [list(matrix[i]) + [col[i] for col in rhs] for i in range(n)]
+    for c in range(n):
+        p = max(range(c, n), key = lambda r: abs(a[r][c]))
+        a[c], a[p] = a[p], a[c]
+        pivot = a[c][c]
+        a[c] = [v / pivot for v in a[c]]
+        for r in range(n):
+            if r != c and a[r][c] != 0:
+                f = a[r][c]
+                a[r] = [v - f * w for v, w in zip(a[r], a[c])]
+    return [[a[i][n + j] for i in range(n)] for j in range(len(rhs))]
+
+#########################################################
+
+#########################################################
+# Class : mpc                                           #
+#########################################################
+class mpc(object):
+    def __init__(self):
+        #Initialize everything, use updatesettings for that
+        self.sample_time = 1.0
+        self.period = 1.0
+        self.gain = -1.0
+        self.a = 0.0
+        self.b = -1.0
+        self.delay = 0
+        self.outputmin = 0.0
+        self.outputmax = 100.0
+        self.slew = 100.0
+        self.setpoint = 40.0
+        self.gsum = 0.0
+        self.alpha = 0.0
+        self.beta = []
+        self.gamma = 0.0
+
+        self.clear()
+
+    def __del__(self):
+        pass
+
+    def clear(self, output = None):
+        #Clears computations, the model is assumed steady at output
+        if output == None:
+            output = self.outputmin
+        self.output = output
+        # inputs that are not yet visible in the temperature (dead time)
+        self.pipeline = deque([output] * self.delay, maxlen = max(self.delay, 1))
+        self.state = self.gain * output
+
+        self.current_time = time()
+        self.last_time = self.current_time
+
+        return self.output
+
+    def updateSettings(self, frequency = 1.0, gain = -1.0, tau = 60.0, deadtime = 0.0, horizon = 0.0, moves = 3, weight = 1.0,
+                       outputmin = 0.0, outputmax = 100.0, slew = 100.0, setpoint = 40.0):
+        """MPC that should be updated at a regular interval (frequency), the model is discretized at this interval.
+        Only the first optimal move is used and the gains for it are precomputed, an update costs O(dead time).
+        """
+        self.period = 1/frequency
+        self.sample_time = self.period/2
+        """Model: gain in degrees per output unit (negative for cooling), time constant and dead time in seconds"""
+        self.gain = gain
+        self.a = exp(-self.period / tau)
+        self.b = gain * (1 - self.a)
+        self.delay = int(round(deadtime / self.period))
+        """Number of control moves and prediction horizon in seconds, default horizon is time constant + dead time"""
+        moves = max(int(moves), 1)
+        if horizon <= 0:
+            horizon = tau + deadtime
+        steps = max(int(round(horizon / self.period)), self.delay + moves + 1)
+        """Move suppression, relative to the temperature effect of a move"""
+        self.weight = weight
+        """Determines the minimum and maximum output"""
+        self.outputmin = outputmin
+        self.outputmax = outputmax
+        """Maximum output change per second"""
+        self.slew = slew
+        """This is the required setpoint for the controller"""
+        self.setpoint = setpoint
+
+        self._gains(steps, moves)
+        self.clear()
+
+    def getstate(self):
+        """State to continue the controller after a restart, the model restarts steady at the output"""
+        return {'output': self.output}
+
+    def setstate(self, state):
+        self.clear(state['output'])
+
+    def updateCommand(self, setpoint = 40.0):
+        self.setpoint = setpoint
+
+    def update(self, feedback_value, current_time=None):
+        """Calculates the MPC output for given reference feedback
+        """
+        self.current_time = current_time if current_time is not None else time()
+        delta_time = self.current_time - self.last_time
+
+        if delta_time >= self.sample_time:
+            self.last_time = self.current_time
+            # the difference between measurement and model is a (constant) disturbance: offset free control
+            disturbance = feedback_value - self.state
+            move = self.gsum * (self.setpoint - disturbance) - self.alpha * self.state - self.gamma * self.output
+            for beta, past in zip(self.beta, self.pipeline):
+                move -= beta * past
+            maxmove = self.slew * delta_time
+            if move > maxmove:
+                move = maxmove
+            elif move < -maxmove:
+                move = -maxmove
+            output = self.output + move
+            if output > self.outputmax:
+                output = self.outputmax
+            elif output < self.outputmin:
+                output = self.outputmin
+
+            # Advance the model with the input that reaches the temperature now
+            if self.delay > 0:
+                self.state = self.a * self.state + self.b * self.pipeline[0]
+                self.pipeline.append(output)
+            else:
+                self.state = self.a * self.state + self.b * output
+            self.output = output
+
+        return self.output
+
+    def _gains(self, steps, moves):
+        # Step response of the model and the first row of the unconstrained MPC gain (G'G + wI)^-1 G'
+        a = self.a
+        d = self.delay
+        step = [0.0] * (steps + 1)
+        for n in range(d + 1, steps + 1):
+            step[n] = self.gain * (1 - a ** (n - d))
+        G = [[step[i - m] if i > m else 0.0 for m in range(moves)] for i in range(1, steps + 1)]
+        w = self.weight * self.gain * self.gain
+        H = [[sum(G[i][r] * G[i][c] for i in range(steps)) + (w if r == c else 0.0) for c in range(moves)] for r in range(moves)]
+        Gt = [[G[i][m] for m in range(moves)] for i in range(steps)]
+        k = [col[0] for col in _solve(H, Gt)]
+
+        # Fold the free response (state, dead time inputs and held output) into scalar gains
+        self.gsum = sum(k)
+        self.alpha = sum(k[i-1] * a ** i for i in range(1, steps + 1))
+        self.beta = [sum(k[i-1] * self.b * a ** (i - j - 1) for i in range(j + 1, steps + 1)) for j in range(d)]
+        if a < 1:
+            self.gamma = sum(k[i-1] * self.b * (1 - a ** (i - d)) / (1 - a) for i in range(d + 1, steps + 1))
+        else:
+            self.gamma = 0.0
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
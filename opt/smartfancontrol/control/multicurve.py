@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : multicurve.py                               #
+#           Implements a fan curve per sensor, the      #
+#           demands are combined to one fan output      #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from control.curve import curve
+#########################################################
+
+####################### GLOBALS #########################
+COMBINE_MAX      = 0
+COMBINE_WEIGHTED = 1
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : multicurve                                    #
+#########################################################
+class multicurve(object):
+    def __init__(self, sensors = 1):
+        self.combine = COMBINE_MAX
+        self.curves = []
+        self.weights = [1.0] * sensors
+        for i in range(sensors):
+            self.curves.append(curve())
+        self.outputs = [0.0] * sensors
+        self.output = 0.0
+
+    def __del__(self):
+        del self.curves
+
+    def clear(self):
+        #Clears computations
+        for i in range(len(self.curves)):
+            self.outputs[i] = self.curves[i].clear()
+        self.output = 0.0
+        return self.output
+
+    def updateSettings(self, sensor, frequency = 1.0, outputmin = 0.0, outputmax = 100.0, points = [], fallpoints = [], weight = 1.0):
+        """Sets the curve and weight for one sensor, see curve for the curve settings"""
+        self.curves[sensor].updateSettings(frequency = frequency, outputmin = outputmin, outputmax = outputmax,
+                                           points = points, fallpoints = fallpoints)
+        self.weights[sensor] = weight
+
+    def updateCombine(self, combine = COMBINE_MAX):
+        """Combine the sensor demands by taking the maximum or the weighted average"""
+        self.combine = combine
+
+    def update(self, feedback_values, current_time=None):
+        """Calculates the combined curve value for a list of sensor values, None if a sensor is not available
+        """
+        maxoutput = 0.0
+        weighted = 0.0
+        weights = 0.0
+        for i in range(len(self.curves)):
+            if feedback_values[i] != None:
+                output = self.curves[i].update(feedback_values[i], current_time)
+                self.outputs[i] = output
+                if output > maxoutput:
+                    maxoutput = output
+                weighted += self.weights[i] * output
+                weights += self.weights[i]
+        if self.combine == COMBINE_WEIGHTED:
+            if weights > 0:
+                self.output = weighted / weights
+                # a running fan needs at least the minimum output
+                if self.output > 0 and self.output < self.curves[0].outputmin:
+                    self.output = self.curves[0].outputmin
+            else:
+                self.output = 0.0
+        else:
+            self.output = maxoutput
+
+        return self.output
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
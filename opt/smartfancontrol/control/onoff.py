@@ -58,6 +58,11 @@ class onoff(object):
         self.setpoint = setpoint
         
         self.clear()
+    
+    def updateCommand(self, setpoint = 40.0, hysteresis = 5.0):
+        """Changes the setpoint and hysteresis while running, the output is kept"""
+        self.setpoint = setpoint
+        self.hysteresis = hysteresis
         
     def update(self, feedback_value, current_time=None):
         """Calculates ONOFF value for given reference feedback
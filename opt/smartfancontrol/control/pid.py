@@ -102,6 +102,50 @@ class pid(object):
     def updateCommand(self, setpoint = 40.0):
         self.setpoint = setpoint
     
+    def updateGains(self, Kp = 1.0, Ki = 0.0, windup = 20.0):
+        """Changes the gains while running, the integral part of the output is kept"""
+        if Ki != 0:
+            self.ITerm = self.ITerm * self.Ki / Ki
+        else:
+            self.ITerm = 0.0
+        self.Kp = Kp
+        self.Ki = Ki
+        self.windup_guard = windup
+    
+    def getstate(self):
+        """State to continue the controller after a restart"""
+        return {'ITerm': self.ITerm, 'last_error': self.last_error, 'output': self.output}
+
+    def setstate(self, state):
+        self.ITerm = state['ITerm']
+        self.last_error = state['last_error']
+        self.output = state['output']
+    
+    def bumpless(self, output, feedback_value):
+        """Initializes the integrator to continue at output with the current feedback (bumpless transfer)"""
+        error = (self.setpoint - feedback_value) * self.sign
+        self.PTerm = self.Kp * error
+        self.ITerm = 0.0
+        if self.Ki != 0:
+            self.ITerm = (output - self.PTerm) / self.Ki
+            if self.ITerm < -self.windup_guard:
+                self.ITerm = -self.windup_guard
+            elif self.ITerm > self.windup_guard:
+                self.ITerm = self.windup_guard
+        self.DTerm = 0.0
+        self.last_error = error
+
+        self.output = output
+        if self.output > self.outputmax:
+            self.output = self.outputmax
+        elif self.output < self.outputmin:
+            self.output = self.outputmin
+
+        self.current_time = time()
+        self.last_time = self.current_time
+
+        return self.output
+    
     def update(self, feedback_value, current_time=None):
         """Calculates PID value for given reference feedback
         .. math::
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : pid2.py                                     #
+#           Implements a two degree of freedom PID      #
+#           control loop (setpoint weighting, filtered  #
+#           derivative on the measurement, back         #
+#           calculation anti windup and slew limiting)  #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from time import time
+#########################################################
+
+####################### GLOBALS #########################
+
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : pid2                                          #
+#########################################################
+class pid2(object):
+    def __init__(self):
+        #Initialize everything to 0, use updatesettings for that
+        self.Kp = 1.0
+        self.Ki = 0.0
+        self.Kd = 0.0
+
+        self.sample_time = 1.0
+        self.direction = 0
+        self.sign = 1
+        self.outputmin = 0.0
+        self.outputmax = 100.0
+        self.setpoint = 40.0
+        self.weight = 1.0
+        self.filter = 10.0
+        self.Tf = 0.0
+        self.tracking = 0.0
+        self.Tt = 0.0
+        self.slew = 0.0
+
+        self.clear()
+
+    def __del__(self):
+        pass
+
+    def clear(self, output = None):
+        #Clears PID computations, the integral part is initialized to output if given
+        self.PTerm = 0.0
+        self.ITerm = 0.0
+        self.DTerm = 0.0
+        self.last_feedback = None
+
+        self.output = 0.0
+        if output != None:
+            self.ITerm = output
+            self.output = output
+
+        self.current_time = time()
+        self.last_time = self.current_time
+
+        return self.output
+
+    def updateSettings(self, Kp = 1.0, Ki = 0.0, Kd = 0.0, frequency = 1.0, direction = 0, sign = 1, outputmin = 0.0, outputmax = 100.0, windup = 20.0,
+                       setpoint = 40.0, weight = 1.0, filter = 10.0, tracking = 0.0, slew = 0.0):
+        """Gains as in pid, the integral part is kept in output units (Ki * integral of the error)"""
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+        """Direction, sign, output limits and frequency as in pid"""
+        self.direction = direction
+        self.sign = sign
+        self.outputmin = outputmin
+        self.outputmax = outputmax
+        self.sample_time = 1/frequency
+        """Windup is not used, the integral part is limited by back calculation"""
+        """This is the required setpoint for the PID controller"""
+        self.setpoint = setpoint
+        """Setpoint weight of the P part (0 .. 1), lower values give less overshoot and no P kick on setpoint changes.
+        The I part always uses the full error, the D part only uses the measurement (no D kick).
+        """
+        self.weight = weight
+        """Derivative filter N, the derivative is filtered with a time constant of Td / N"""
+        self.filter = filter
+        """Back calculation tracking time constant in seconds, 0 is sqrt(Ti * Td), or Ti for a PI controller"""
+        self.tracking = tracking
+        """Maximum output change per second, 0 is no limit"""
+        self.slew = slew
+
+        self._timeconstants()
+        self.clear()
+
+    def updateCommand(self, setpoint = 40.0):
+        self.setpoint = setpoint
+
+    def updateGains(self, Kp = 1.0, Ki = 0.0, windup = 20.0):
+        """Changes the gains while running, the integral part of the output is kept"""
+        self.Kp = Kp
+        self.Ki = Ki
+        if Ki == 0:
+            self.ITerm = 0.0
+        self._timeconstants()
+
+    def getstate(self):
+        """State to continue the controller after a restart"""
+        return {'ITerm': self.ITerm, 'DTerm': self.DTerm, 'last_feedback': self.last_feedback, 'output': self.output}
+
+    def setstate(self, state):
+        self.ITerm = state['ITerm']
+        self.DTerm = state['DTerm']
+        self.last_feedback = state['last_feedback']
+        self.output = state['output']
+
+    def bumpless(self, output, feedback_value):
+        """Initializes the integral part to continue at output with the current feedback (bumpless transfer)"""
+        self.PTerm = self.Kp * (self.weight * self.setpoint - feedback_value) * self.sign
+        self.ITerm = 0.0
+        if self.Ki != 0:
+            self.ITerm = output - self.PTerm
+        self.DTerm = 0.0
+        self.last_feedback = feedback_value
+
+        self.output = output
+        if self.output > self.outputmax:
+            self.output = self.outputmax
+        elif self.output < self.outputmin:
+            self.output = self.outputmin
+
+        self.current_time = time()
+        self.last_time = self.current_time
+
+        return self.output
+
+    def update(self, feedback_value, current_time=None):
+        """Calculates PID value for given reference feedback
+        .. math::
+            v(t) = K_p (b r(t) - y(t)) + K_i \int_{0}^{t} e(t)dt - K_d {dy_f}/{dt}
+            {dI}/{dt} = K_i e(t) + (u(t) - v(t)) / T_t, with u(t) the limited output
+        """
+
+        self.current_time = current_time if current_time is not None else time()
+        delta_time = self.current_time - self.last_time
+
+        if delta_time >= self.sample_time:
+            error = (self.setpoint - feedback_value) * self.sign
+
+            self.PTerm = self.Kp * (self.weight * self.setpoint - feedback_value) * self.sign
+            if self.Kd != 0 and self.last_feedback != None:
+                # first order filtered derivative on the measurement (backward Euler)
+                self.DTerm = (self.Tf * self.DTerm - self.Kd * (feedback_value - self.last_feedback) * self.sign) / (self.Tf + delta_time)
+
+            if self.Ki != 0:
+                self.ITerm += self.Ki * error * delta_time
+
+            value = self.PTerm + self.ITerm + self.DTerm
+            output = value
+            if output > self.outputmax:
+                output = self.outputmax
+            elif output < self.outputmin:
+                output = self.outputmin
+            if self.slew > 0:
+                maxstep = self.slew * delta_time
+                if output > self.output + maxstep:
+                    output = self.output + maxstep
+                elif output < self.output - maxstep:
+                    output = self.output - maxstep
+
+            # back calculation: the integral tracks the limited output
+            if self.Ki != 0:
+                self.ITerm += (output - value) * delta_time / self.Tt
+
+            # Remember last time and last feedback for next calculation
+            self.last_time = self.current_time
+            self.last_feedback = feedback_value
+            self.output = output
+
+            # Update for direction, if < 0 then reset
+            if self.direction * error < 0:
+                self.ITerm = 0.0
+                self.output = self.outputmin
+
+        return self.output
+
+    def _timeconstants(self):
+        # Derivative filter and tracking time constants from the gains
+        Ti = 0.0
+        Td = 0.0
+        if self.Kp != 0:
+            if self.Ki != 0:
+                Ti = abs(self.Kp / self.Ki)
+            Td = abs(self.Kd / self.Kp)
+        self.Tf = Td / self.filter if self.filter > 0 else 0.0
+        self.Tt = self.tracking
+        if self.Tt <= 0:
+            self.Tt = (Ti * Td) ** 0.5 if Td > 0 else Ti
+        # a tracking time shorter than the update interval makes the integral oscillate
+        if self.Tt < 2 * self.sample_time:
+            self.Tt = 2 * self.sample_time
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
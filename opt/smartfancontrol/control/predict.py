@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : predict.py                                  #
+#           Predicts a value ahead in time from its     #
+#           trend (sliding linear regression)           #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from time import time
+from array import array
+#########################################################
+
+####################### GLOBALS #########################
+MINSAMPLES = 3
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : predict                                       #
+#########################################################
+class predict(object):
+    def __init__(self):
+        self.horizon = 0.0
+        self.size = MINSAMPLES
+        self.clear()
+
+    def __del__(self):
+        pass
+
+    def clear(self):
+        #Clears computations
+        self.times = array('d', [0.0] * self.size)
+        self.values = array('d', [0.0] * self.size)
+        self.index = 0
+        self.count = 0
+        self.t0 = 0.0
+        self._sums()
+        self.slope = 0.0
+        self.output = 0.0
+        return self.output
+
+    def updateSettings(self, frequency = 1.0, horizon = 0.0, window = 30.0):
+        """Predictor that should be updated at a regular interval.
+        The frequency is the expected update frequency, used to size the regression window.
+        """
+        """Time to look ahead in seconds"""
+        self.horizon = horizon
+        """Time of the sliding window used for the trend in seconds"""
+        self.size = max(int(round(window * frequency)), MINSAMPLES)
+
+        self.clear()
+
+    def update(self, feedback_value, current_time=None):
+        """Adds a new sample and returns the value predicted horizon seconds ahead
+        """
+        current_time = current_time if current_time is not None else time()
+
+        if self.count == 0:
+            self.t0 = current_time
+        if self.count >= self.size:
+            # remove the oldest sample from the running sums
+            self._remove(self.times[self.index], self.values[self.index])
+        else:
+            self.count += 1
+        t = current_time - self.t0
+        self.times[self.index] = t
+        self.values[self.index] = feedback_value
+        self._add(t, feedback_value)
+        self.index += 1
+        if self.index >= self.size:
+            # rebase times once per window, to keep the running sums accurate
+            self.index = 0
+            self._rebase()
+
+        self.slope = 0.0
+        if self.count >= MINSAMPLES:
+            denom = self.count * self.stt - self.st * self.st
+            if denom > 0:
+                self.slope = (self.count * self.stv - self.st * self.sv) / denom
+        self.output = feedback_value + self.slope * self.horizon
+
+        return self.output
+
+    def getslope(self):
+        """Returns the trend in units per second"""
+        return self.slope
+
+    def _sums(self):
+        self.st = 0.0
+        self.sv = 0.0
+        self.stt = 0.0
+        self.stv = 0.0
+
+    def _add(self, t, v):
+        self.st += t
+        self.sv += v
+        self.stt += t * t
+        self.stv += t * v
+
+    def _remove(self, t, v):
+        self.st -= t
+        self.sv -= v
+        self.stt -= t * t
+        self.stv -= t * v
+
+    def _rebase(self):
+        # the buffer is full and index 0 holds the oldest sample
+        shift = self.times[0]
+        self.t0 += shift
+        self._sums()
+        for i in range(self.count):
+            self.times[i] -= shift
+            self._add(self.times[i], self.values[i])
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
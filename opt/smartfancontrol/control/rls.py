@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : rls.py                                      #
+#           Recursive least squares estimation of a     #
+#           first order plus dead time model, used to   #
+#           adapt PI gains while running                #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from time import time
+from math import log
+from collections import deque
+from control.fopdt import fopdt
+#########################################################
+
+####################### GLOBALS #########################
+NPARAM     = 3       # y[k] = a * y[k-1] + b * u[k-1-delay] + c
+PSTART     = 1000.0  # initial covariance
+TRACEMAX   = 10000.0 # no forgetting above this covariance trace (no excitation)
+MINMEMORY  = 0.5     # part of the memory to collect before the model is used
+GAPPERIODS = 2.5     # a longer time between samples restarts the regressor
+GAINCHANGE = 0.1     # minimum relative gain change to adapt
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : rls                                           #
+#########################################################
+class rls(object):
+    def __init__(self):
+        #Initialize everything, use updatesettings for that
+        self.sample_time = 1.0
+        self.period = 1.0
+        self.forget = 1.0
+        self.delay = 0
+        self.deadtime = 0.0
+        self.minsamples = 1
+        self.interval = 10.0
+        self.minfactor = 0.25
+        self.maxfactor = 4.0
+        self.sign = 1
+        self.basegains = (1.0, 0.0)
+        self.gains = self.basegains
+        self.adapt_time = time()
+        self.model = fopdt()
+        self.clear()
+
+    def __del__(self):
+        del self.model
+
+    def clear(self):
+        #Clears the estimation
+        self.theta = [0.0] * NPARAM
+        self.P = [[PSTART if r == c else 0.0 for c in range(NPARAM)] for r in range(NPARAM)]
+        self.inputs = deque(maxlen = self.delay + 1)
+        self.last_value = None
+        self.count = 0
+        self.model.clear()
+
+        self.current_time = time()
+        self.last_time = self.current_time
+
+    def updateSettings(self, frequency = 1.0, memory = 60.0, deadtime = 0.0, interval = 10.0, minfactor = 0.25, maxfactor = 4.0, sign = 1):
+        """Estimator that should be updated at a regular interval (frequency), the model is discretized at this interval."""
+        self.period = 1/frequency
+        self.sample_time = self.period/2
+        """Memory of the estimator in seconds, older samples are forgotten exponentially"""
+        samples = max(memory * frequency, 1.0)
+        self.forget = 1.0 - 1.0/samples
+        self.minsamples = int(samples * MINMEMORY)
+        """Dead time in seconds is not estimated, but taken from the step response (-d) or 0"""
+        self.deadtime = deadtime
+        self.delay = int(round(deadtime / self.period))
+        """Interval in seconds to adapt the gains, adapted gains are limited to minfactor .. maxfactor times the configured gains"""
+        self.interval = interval
+        self.minfactor = minfactor
+        self.maxfactor = maxfactor
+        """Expected sign of the process gain, e.g. -1 for a higher fan speed that lowers the temperature"""
+        self.sign = sign
+
+        self.clear()
+
+    def updateGains(self, Kp = 1.0, Ki = 0.0):
+        """Configured gains, the gains are adapted around them. The adapt interval restarts."""
+        self.basegains = (Kp, Ki)
+        self.gains = self.basegains
+        self.adapt_time = time()
+
+    def update(self, feedback_value, input_value, current_time=None):
+        """Adds a sample of the process value and the process input, returns whether the model is valid
+        """
+        self.current_time = current_time if current_time is not None else time()
+        delta_time = self.current_time - self.last_time
+
+        if delta_time >= self.sample_time:
+            self.last_time = self.current_time
+            if delta_time > GAPPERIODS * self.period:
+                # samples are not consecutive, e.g. the control loop was not active
+                self.inputs.clear()
+                self.last_value = None
+            if self.last_value != None and len(self.inputs) > self.delay:
+                self._estimate([self.last_value, self.inputs[0], 1.0], feedback_value)
+            self.inputs.append(input_value)
+            self.last_value = feedback_value
+
+        return self.model.valid()
+
+    def adapt(self, current_time=None):
+        """Returns the adapted (Kp, Ki) once every interval if they differ enough from the current gains, otherwise None
+        """
+        now = current_time if current_time is not None else time()
+        if now - self.adapt_time < self.interval:
+            return None
+        self.adapt_time = now
+        Kp, Ki = self.tunePI(self.basegains[0], self.basegains[1], self.minfactor, self.maxfactor, self.sign)
+        if abs(Kp - self.gains[0]) > GAINCHANGE * self.gains[0] or abs(Ki - self.gains[1]) > GAINCHANGE * self.gains[1]:
+            self.gains = (Kp, Ki)
+            return self.gains
+        return None
+
+    def tunePI(self, Kp, Ki, minfactor = 0.25, maxfactor = 4.0, sign = 1):
+        """PI gains from the estimated model, limited to minfactor .. maxfactor times the configured gains Kp and Ki.
+        Returns the configured gains if the model is not valid or the sign of the process gain is not as expected.
+        """
+        if not self.model.valid() or self.model.gain * sign < 0:
+            return Kp, Ki
+        newKp, newKi = self.model.tunePI()
+        return self._limit(newKp, Kp, minfactor, maxfactor), self._limit(newKi, Ki, minfactor, maxfactor)
+
+    def _limit(self, value, base, minfactor, maxfactor):
+        if value < base * minfactor:
+            value = base * minfactor
+        elif value > base * maxfactor:
+            value = base * maxfactor
+        return value
+
+    def _estimate(self, phi, value):
+        # One RLS step with forgetting, P is only forgotten while there is excitation (bounded trace)
+        Pphi = [sum(self.P[r][c] * phi[c] for c in range(NPARAM)) for r in range(NPARAM)]
+        trace = sum(self.P[r][r] for r in range(NPARAM))
+        forget = self.forget if trace < TRACEMAX else 1.0
+        denom = forget + sum(phi[r] * Pphi[r] for r in range(NPARAM))
+        error = value - sum(self.theta[r] * phi[r] for r in range(NPARAM))
+        gain = [Pphi[r] / denom for r in range(NPARAM)]
+        for r in range(NPARAM):
+            self.theta[r] += gain[r] * error
+            for c in range(NPARAM):
+                self.P[r][c] = (self.P[r][c] - gain[r] * Pphi[c]) / forget
+        self.count += 1
+
+        # Convert to a continuous model: K = b / (1 - a), tau = -T / ln(a)
+        a = self.theta[0]
+        b = self.theta[1]
+        self.model.clear()
+        if self.count >= self.minsamples and a > 0 and a < 1 and b != 0:
+            self.model.gain = b / (1 - a)
+            self.model.tau = -self.period / log(a)
+            self.model.deadtime = self.deadtime
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
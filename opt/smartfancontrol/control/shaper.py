@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : shaper.py                                   #
+#           Shapes the fan demand of a controller       #
+#           (slew rates, dwell time and a cap)          #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from time import time
+#########################################################
+
+####################### GLOBALS #########################
+
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : shaper                                        #
+#########################################################
+class shaper(object):
+    def __init__(self):
+        #Initialize everything, use updatesettings for that
+        self.outputmin = 0.0
+        self.outputmax = 100.0
+        self.slewup = 0.0
+        self.slewdown = 0.0
+        self.dwell = 0.0
+        self.updates = 0
+        self.slewlimited = 0
+        self.dwellheld = 0
+        self.capped = 0
+        self.clear()
+
+    def __del__(self):
+        pass
+
+    def clear(self, output = 0.0):
+        #Clears the shaping state, the shaper continues from output, the counters are kept
+        self.output = output
+        self.direction = 0
+        self.current_time = time()
+        self.last_time = self.current_time
+        self.change_time = 0.0
+
+        return self.output
+
+    def updateSettings(self, outputmin = 0.0, outputmax = 100.0, slewup = 0.0, slewdown = 0.0, dwell = 0.0):
+        """Output range of the fan, below outputmin the fan is off"""
+        self.outputmin = outputmin
+        self.outputmax = outputmax
+        """Maximum output increase and decrease per second, 0 is no limit"""
+        self.slewup = slewup
+        self.slewdown = slewdown
+        """Minimum time in seconds before the output changes direction or starts changing again"""
+        self.dwell = dwell
+
+        self.clear()
+
+    def updateRates(self, slewup = 0.0, slewdown = 0.0, dwell = 0.0):
+        """Changes the slew rates and dwell time while running, the output is kept"""
+        self.slewup = slewup
+        self.slewdown = slewdown
+        self.dwell = dwell
+
+    def update(self, value, cap = None, current_time = None):
+        """Shapes the demand, cap is an optional maximum (e.g. quiet hours).
+        Only scalars are used, so shaping does not allocate in the control loop.
+        """
+        self.current_time = current_time if current_time is not None else time()
+        delta_time = self.current_time - self.last_time
+        self.updates += 1
+
+        if cap is not None and value > cap:
+            value = cap
+            self.capped += 1
+
+        # full speed is never delayed by the slew rate or the dwell time
+        full = value >= self.outputmax
+        running = self.output >= self.outputmin and self.output > 0
+        if value >= self.outputmin and value > 0:
+            # a standing fan starts at its minimum level
+            last = self.output if running else self.outputmin
+            if self.slewup > 0 and not full and value > last + self.slewup * delta_time:
+                value = last + self.slewup * delta_time
+                self.slewlimited += 1
+            elif running and self.slewdown > 0 and value < last - self.slewdown * delta_time:
+                value = last - self.slewdown * delta_time
+                self.slewlimited += 1
+
+        if value != self.output and self.dwell > 0 and not full:
+            direction = 1 if value > self.output else -1
+            # a ramp in progress continues, a new change or reversal waits for the dwell time
+            ramping = direction == self.direction and self.change_time == self.last_time
+            if not ramping and self.current_time - self.change_time < self.dwell:
+                value = self.output
+                self.dwellheld += 1
+
+        if value != self.output:
+            self.direction = 1 if value > self.output else -1
+            self.change_time = self.current_time
+        self.last_time = self.current_time
+        self.output = value
+
+        return self.output
+
+    def metrics(self):
+        """Shaping counters as (name, value)"""
+        return [("shaper_updates_total", self.updates),
+                ("shaper_slew_limited_total", self.slewlimited),
+                ("shaper_dwell_held_total", self.dwellheld),
+                ("shaper_capped_total", self.capped)]
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -9,9 +9,12 @@
 ####################### IMPORTS #########################
 from common.common import common
 from common.stdin import stdin
+from control.characteristic import characteristic
+from hardware.temp import ABS_NULL
 from datetime import datetime, timedelta
 from threading import Timer
-from time import sleep
+from time import sleep, time
+import os
 #########################################################
 
 ####################### GLOBALS #########################
@@ -21,6 +24,22 @@ MANUALPWMDELTA = 5
 MAXPWM = 100
 MINPWM = 0
 DEFRECAL = 7
+DEFRECALWINDOW = 24 # hours
+DEFRECALLOAD = 0.5 # load average per cpu
+DEFRECALTEMP = 5 # below TempStart
+DEFTEMPSTART = 45
+RECALPOLL = 60 # seconds
+CALSTATE = "calibration"
+CURVESTATE = "characteristic"
+CURVEPWMDELTA = 5
+CURVESETUPTIME = 3 # seconds
+STARTPROBES = 7 # resolution of 100/2^7 < 1%
+STARTSETUPTIME = 3 # seconds
+STOPTIMEOUT = 10 # seconds
+STOPPOLL = 0.5 # seconds
+STARTMARGIN = 2
+CALKEYS = ("mode", "ONOFFgpio", "ONOFFinvert", "PWMcalibrated", "PWMgpio", "PWMfrequency", "PWMinvert",
+           "RPMgpio", "RPMpullup", "RPMppr", "RPMedge", "RPMfiltersize")
 #########################################################
 
 ###################### FUNCTIONS ########################
@@ -31,12 +50,14 @@ DEFRECAL = 7
 # Class : calibrate                                     #
 #########################################################
 class calibrate(common):
-    def __init__(self, rpm, fanoutput, mutex, settings, logger, exitevent, autocal = True):
+    def __init__(self, rpm, fanoutput, mutex, settings, logger, exitevent, autocal = True, state = None, temp = None, fanid = 1, resume = False):
         self.fanoutput = fanoutput
         self.rpm = rpm
         self.mutex = mutex
         self.logger = logger
         self.exitevent = exitevent
+        self.state = state
+        self.temp = temp
         common.__init__(self, self.logger)
         mode = self.checkkey(settings, 'fan', 'mode')
         if mode:
@@ -44,16 +65,33 @@ class calibrate(common):
         else:
             self.auto = autocal
         self.recalibrate =  self.checkkeydef(settings, 'fan', 'recalibrate', DEFRECAL)            
+        self.recalwindow = self.checkkeydef(settings, 'fan', 'recalwindow', DEFRECALWINDOW)
+        self.recalload = self.checkkeydef(settings, 'fan', 'recalload', DEFRECALLOAD)
+        self.recaltemp = self.checkkeydef(settings, 'control', 'TempStart', DEFTEMPSTART) - self.checkkeydef(settings, 'fan', 'recaltemp', DEFRECALTEMP)
+        self.windowend = 0
+        # every fan keeps its own calibration state
+        self.calstate = CALSTATE
+        self.curvestate = CURVESTATE
+        if fanid > 1:
+            self.calstate += str(fanid)
+            self.curvestate += str(fanid)
         self.valuemin = 0 # if auto, calibration is always on max RPM, otherwise min PWM
         self.valuemax = 0
         self.timer = None
-        
+        self.characteristic = characteristic()
+        self.fingerprint = ""
+        if self.state:
+            self.fingerprint = self.state.fingerprint(settings, 'fan', CALKEYS)
+            self.loadCharacteristic()
+
         self.calpwm = self.checkkeydef(settings, 'fan', 'PWMcalibrated', DEFAULTMANUALSTARTPERC)
         if self.calpwm <= 0:
             self.calpwm = 1.0 # minimum PWM value to keep the fan running
                
         if self.auto:
-            self.autoCalibrate()
+            # on a handover, an outdated calibration is used until the next recalibration window
+            if not self.loadCalibration(resume):
+                self.autoCalibrate()
         else:
             self.valuemin = self.calpwm
 
@@ -64,12 +102,19 @@ class calibrate(common):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+
+    def trigger(self):
+        # Calibrate now on demand, independent of the load and temperature
+        if self.auto and not self.exitevent.is_set():
+            self.logi("Auto calibration requested")
+            self._timer(0, self.autoCalibrate)
     
     def get(self):
         return self.valuemin, self.valuemax
     
     def autoCalibrate(self):
         self.logi("Auto calibrating")
+        self.windowend = 0
         self.mutex.acquire()
         self.fanoutput.set(MAXPWM)
         self.exitevent.wait(AUTOCALSETUPTIME)
@@ -83,18 +128,121 @@ class calibrate(common):
             self.logi("Auto calibration finished, minimum RPM: {:.3f}, maximum RPM: {:.3f}".format(self.valuemin, self.valuemax))
             self.logi("Schedule for next auto calibration in {} days at 12:00 PM".format(self.recalibrate))
             self.rpm.setmax(self.valuemax*1.2)
+            self.storeCalibration()
         if not self.exitevent.is_set():
             #schedule next calibration
-            if self.timer:
-                self.timer.cancel()
-                self.timer = None
-            now=datetime.today()
-            nextcal=now.replace(day=now.day, hour=0, minute=0, second=0, microsecond=0) + timedelta(days=self.recalibrate)
-            deltacalsecs=(nextcal-now).total_seconds()
-            self.timer = Timer(deltacalsecs, self.autoCalibrate)
-            self.timer.start()
+            self._schedule(datetime.today())
         self.mutex.release()
+
+    def loadCalibration(self, anyage = False):
+        # Reuse the stored calibration if it is recent enough and the fan configuration is unchanged
+        if not self.state:
+            return False
+        cal = self.state.get(self.calstate)
+        if not cal:
+            return False
+        try:
+            if cal['fingerprint'] != self.fingerprint or cal['valuemax'] <= 0:
+                return False
+            age = time() - cal['timestamp']
+            if not anyage and (age < 0 or age >= self.recalibrate*24*3600):
+                return False
+            self.valuemin = cal['valuemin']
+            self.valuemax = cal['valuemax']
+        except:
+            return False
+        self.rpm.setmax(self.valuemax*1.2)
+        self.logi("Using stored calibration, minimum RPM: {:.3f}, maximum RPM: {:.3f}".format(self.valuemin, self.valuemax))
+        self._schedule(datetime.fromtimestamp(cal['timestamp']))
+        return True
+
+    def storeCalibration(self):
+        if self.state and self.valuemax > 0:
+            self.state.set(self.calstate, {'fingerprint': self.fingerprint, 'timestamp': time(),
+                                      'valuemin': self.valuemin, 'valuemax': self.valuemax})
+
+    def _schedule(self, lastcal):
+        now=datetime.today()
+        nextcal=lastcal.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=self.recalibrate)
+        deltacalsecs=max((nextcal-now).total_seconds(), 0)
+        self._timer(deltacalsecs, self._recalibrate)
+
+    def _timer(self, delay, function):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.timer = Timer(delay, function)
+        self.timer.start()
+
+    def _recalibrate(self):
+        # Recalibration is due, wait inside the window for a cool and quiet system
+        now = time()
+        if not self.windowend:
+            self.windowend = now + self.recalwindow*3600
+        if self._recalconditions():
+            self.autoCalibrate()
+        elif now < self.windowend:
+            self._timer(RECALPOLL, self._recalibrate)
+        else:
+            self.logi("System too busy or too hot for auto calibration, postponed for 1 day")
+            self.windowend = 0
+            self._timer(24*3600, self._recalibrate)
+
+    def _recalconditions(self):
+        ok = True
+        if self.temp:
+            # without a temperature reading the fan may be needed, so calibration is postponed
+            tempval = self.temp.get()
+            if tempval <= ABS_NULL or tempval >= self.recaltemp:
+                ok = False
+        try:
+            if os.getloadavg()[0] / os.cpu_count() >= self.recalload:
+                ok = False
+        except:
+            pass
+        return ok
     
+    def curveCalibrate(self):
+        # Sweep PWM down from maximum to record the steady state PWM to RPM characteristic
+        print("PWM to RPM characteristic calibration")
+        self.mutex.acquire()
+        pwms = []
+        rpms = []
+        pwmlevel = MAXPWM
+        self.fanoutput.set(MAXPWM)
+        self.exitevent.wait(AUTOCALSETUPTIME)
+        while pwmlevel >= MINPWM and not self.exitevent.is_set():
+            self.fanoutput.set(pwmlevel)
+            self.exitevent.wait(CURVESETUPTIME)
+            if not self.exitevent.is_set():
+                pwms.append(pwmlevel)
+                rpms.append(round(self.rpm.get(), 1))
+                print("PWM: {:.2f}, RPM: {:.2f}".format(pwms[-1], rpms[-1]))
+            pwmlevel -= CURVEPWMDELTA
+        self.fanoutput.set(MINPWM)
+        self.mutex.release()
+
+        if not self.exitevent.is_set():
+            self.characteristic.updateSettings(pwms, rpms)
+            if self.characteristic.valid():
+                if self.state:
+                    self.state.set(self.curvestate, {'fingerprint': self.fingerprint, 'timestamp': time(),
+                                                'pwm': self.characteristic.pwms, 'rpm': self.characteristic.rpms})
+                print("PWM to RPM characteristic calibration finished")
+            else:
+                self.characteristic.clear()
+                print("PWM to RPM characteristic calibration failed, fan is not running")
+        return self.characteristic.valid()
+
+    def loadCharacteristic(self):
+        curve = self.state.get(self.curvestate)
+        if curve:
+            try:
+                if curve['fingerprint'] == self.fingerprint:
+                    self.characteristic.updateSettings(curve['pwm'], curve['rpm'])
+            except:
+                self.characteristic.clear()
+
     def manualCalibrate(self):
         print("Manual calibration")
         self.mutex.acquire()
@@ -113,7 +261,65 @@ class calibrate(common):
             print("Manual calibration finished, minimum PWM: {}".format(self.valuemin))
             
         return self.valuemin
-        
+
+    def startCalibrate(self):
+        # Binary search the minimum PWM to start the fan and the minimum PWM to keep it running
+        print("Automatic start PWM calibration")
+        startpwm = 0
+        stallpwm = 0
+        self.mutex.acquire()
+        if self._probe(MAXPWM, False):
+            lo = MINPWM
+            hi = MAXPWM
+            for i in range(STARTPROBES):
+                mid = (lo + hi) / 2
+                if self._probe(mid, False):
+                    hi = mid
+                else:
+                    lo = mid
+                if self.exitevent.is_set():
+                    break
+            startpwm = hi
+            lo = MINPWM
+            for i in range(STARTPROBES):
+                mid = (lo + hi) / 2
+                if self._probe(mid, True):
+                    hi = mid
+                else:
+                    lo = mid
+                if self.exitevent.is_set():
+                    break
+            stallpwm = hi
+        self.fanoutput.set(MINPWM)
+        self.mutex.release()
+
+        if self.exitevent.is_set():
+            return 0, 0
+        if startpwm <= 0:
+            print("Automatic start PWM calibration failed, fan is not running")
+            return 0, 0
+        startpwm = round(min(startpwm + STARTMARGIN, MAXPWM), 1)
+        stallpwm = round(min(stallpwm + STARTMARGIN, startpwm), 1)
+        print("Automatic start PWM calibration finished, start PWM: {}, minimum running PWM: {}, hysteresis: {}".format(startpwm, stallpwm, round(startpwm - stallpwm, 1)))
+        return startpwm, stallpwm
+
+    def _probe(self, pwmlevel, running):
+        # From standstill (start threshold) or from full speed (stall threshold), test if the fan runs at pwmlevel
+        if running:
+            self.fanoutput.set(MAXPWM)
+            self.exitevent.wait(STARTSETUPTIME)
+        else:
+            self.fanoutput.set(MINPWM)
+            stoptime = 0
+            while self.rpm.get() > 0 and stoptime < STOPTIMEOUT and not self.exitevent.is_set():
+                self.exitevent.wait(STOPPOLL)
+                stoptime += STOPPOLL
+        self.fanoutput.set(pwmlevel)
+        self.exitevent.wait(STARTSETUPTIME)
+        isrunning = self.rpm.get() > 0
+        print("PWM: {:.2f}, running: {}".format(pwmlevel, isrunning))
+        return isrunning
+
 ######################### MAIN ##########################
 if __name__ == "__main__":
     pass
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : fanbank.py                                  #
+#           Controls multiple fans from multiple        #
+#           temperature zones with one scheduler        #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from common.common import common
+from threading import Thread, Lock
+from time import time
+from engine.fanctrl import FANCTRL_RPM
+#########################################################
+
+####################### GLOBALS #########################
+IDLE_SLEEP = 1
+MINLEVEL   = 0.001 # keeps a fan without minimum level (ONOFF) switched on
+DEFFAILOVERLEVEL = 100
+DEFFAILOVERRETRY = 60 # seconds
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+"""
+Multiple fans and zones:
+<fan2>, <fan3>, ... Additional fans. Contains the same settings as <fan>, settings that are not entered are
+                    taken from <fan>. Enter at least the gpios of the additional fan.
+<temp2>, <control2>, ... Additional temperature zones. Contain the same settings as <temp> and <control>,
+                    settings that are not entered are taken from <temp> and <control>.
+<Fans> (in <control>, <control2>, ...) The fans that are controlled by the zone with their weight,
+       e.g. 1:1.0,2:0.5. Default is all fans with weight 1.0.
+       The zone demand (fraction of the range between minimum and maximum fan speed) is multiplied by the weight.
+       Every fan runs at the highest demand of all zones that control it.
+
+Failover (in <fan>):
+<FailoverLevel> Fan % the other fans run at least when a fan stalls. Default is 100. 0 disables failover.
+<FailoverGpio> Optional gpio of an ON/ OFF backup fan that is switched on when a fan stalls. Default is empty.
+<FailoverInvert> Invert the backup fan gpio. Default is false.
+<FailoverRetry> Time between kick start retries of a stalled fan in seconds. Default is 60.
+Stalls can only be detected in RPM mode.
+"""
+
+def parsefans(text, nfans):
+    # Parse zone to fan mapping 'fan:weight,fan:weight,...', raises ValueError on a malformed mapping
+    mapping = []
+    if text != None and str(text).strip():
+        for item in str(text).replace(";", ",").split(","):
+            if item.strip():
+                if ":" in item:
+                    fanid, weight = item.split(":")
+                else:
+                    fanid, weight = item, 1.0
+                fanid = int(fanid)
+                if fanid < 1 or fanid > nfans:
+                    raise ValueError("Invalid fan {}".format(fanid))
+                mapping.append((fanid - 1, float(weight)))
+    else:
+        for fan in range(nfans):
+            mapping.append((fan, 1.0))
+    if len(mapping) < 1:
+        raise ValueError("No fans")
+    return mapping
+
+#########################################################
+# Class : fanzone                                       #
+#########################################################
+class fanzone(object):
+    # Fan control for a temperature zone, behaves like a single fanctrl
+    def __init__(self, bank, zone, mapping):
+        self.bank = bank
+        self.zone = zone
+        self.mapping = mapping
+        self.exitevent = bank.exitevent
+        # the fan range of the first fan is used as zone range
+        self.reference = bank.fans[mapping[0][0]]
+
+    def __del__(self):
+        pass
+
+    def __str__(self):
+        return ", ".join([str(self.bank.fans[fan]) for fan, weight in self.mapping])
+
+    def __repr__(self):
+        return ", ".join([repr(self.bank.fans[fan]) for fan, weight in self.mapping])
+
+    def start(self, Kp = -100000, Ki = -100000):
+        for fan, weight in self.mapping:
+            self.bank.fans[fan].start(Kp, Ki)
+
+    def stop(self):
+        for fan, weight in self.mapping:
+            self.bank.fans[fan].stop()
+
+    def set(self, value):
+        demand = 0.0
+        on = value > 0
+        if on:
+            minval = self.reference.min()
+            maxval = self.reference.max()
+            if maxval > minval:
+                demand = (float(value) - minval) / (maxval - minval)
+                if demand < 0.0:
+                    demand = 0.0
+                elif demand > 1.0:
+                    demand = 1.0
+        self.bank.demand(self.zone, on, demand)
+
+    def get(self):
+        return self.reference.get()
+
+    def min(self):
+        return self.reference.min()
+
+    def max(self):
+        return self.reference.max()
+
+    def rpmmode(self):
+        return self.reference.mode == FANCTRL_RPM
+
+#########################################################
+# Class : fanbank                                       #
+#########################################################
+class fanbank(Thread, common):
+    def __init__(self, fans, mappings, settings, logger, exitevent, backup = None):
+        self.fans = fans
+        self.backup = backup
+        self.logger = logger
+        self.exitevent = exitevent
+        self.mutex = Lock()
+        common.__init__(self, self.logger)
+        # demand (on, fraction) per zone and the zones (zone, weight) controlling each fan
+        self.demands = [(False, 0.0)] * len(mappings)
+        self.fanzones = [[] for fan in fans]
+        for zone in range(len(mappings)):
+            for fan, weight in mappings[zone]:
+                self.fanzones[fan].append((zone, weight))
+        self.zones = [fanzone(self, zone, mappings[zone]) for zone in range(len(mappings))]
+        self.rpmfans = [fan for fan in fans if fan.mode == FANCTRL_RPM]
+        self.rpmindex = [fans.index(fan) for fan in self.rpmfans]
+        self.failoverlevel = self.checkkeydef(settings, 'fan', 'FailoverLevel', DEFFAILOVERLEVEL)
+        self.failoverretry = self.checkkeydef(settings, 'fan', 'FailoverRetry', DEFFAILOVERRETRY)
+        if self.checkkey(settings, 'fan', 'FailoverLevel') == 0:
+            self.failoverlevel = 0
+        self.failed = []
+        self.keep = False
+        Thread.__init__(self)
+        Thread.start(self)
+
+    def __del__(self):
+        del self.zones
+
+    def zone(self, zone):
+        return self.zones[zone]
+
+    def start(self):
+        for fan in self.fans:
+            fan.start()
+
+    def stop(self):
+        for fan in self.fans:
+            fan.stop()
+
+    def exit(self):
+        for fan in self.fans:
+            fan.exit()
+        self.exitevent.set()
+
+    def handover(self):
+        # Keep all fans running at their current level on exit
+        self.keep = True
+        for fan in self.fans:
+            fan.handover()
+
+    def getstate(self):
+        return [fan.getstate() for fan in self.fans]
+
+    def recalibrate(self):
+        for fan in self.fans:
+            fan.recalibrate()
+
+    def demand(self, zone, on, demand):
+        # Update the demand of a zone and set the fans controlled by this zone
+        self.mutex.acquire()
+        self.demands[zone] = (on, demand)
+        for fan, weight in self.zones[zone].mapping:
+            self._apply(fan)
+        self.mutex.release()
+
+    def failover(self, fan, stalled):
+        # A fan stalled or recovered, boost the other fans while any fan is stalled
+        self.mutex.acquire()
+        if stalled:
+            self.failed.append(fan)
+            self.loge("{} stalled, failover to other fans".format(self.fans[fan].fanname))
+        else:
+            self.failed.remove(fan)
+            self.logi("{} running again".format(self.fans[fan].fanname))
+        if self.backup:
+            self.backup.set(len(self.failed) > 0)
+        for other in range(len(self.fans)):
+            self._apply(other)
+        self.mutex.release()
+
+    def _apply(self, fan):
+        faton = False
+        fandemand = 0.0
+        for fzone, fweight in self.fanzones[fan]:
+            zon, zdemand = self.demands[fzone]
+            if zon and fweight > 0:
+                faton = True
+                if zdemand * fweight > fandemand:
+                    fandemand = zdemand * fweight
+        if self.failed and self.failoverlevel > 0 and not fan in self.failed:
+            faton = True
+            if self.failoverlevel / 100.0 > fandemand:
+                fandemand = self.failoverlevel / 100.0
+        level = 0.0
+        if faton:
+            minval = self.fans[fan].min()
+            maxval = self.fans[fan].max()
+            level = minval + (maxval - minval) * min(fandemand, 1.0)
+            if level < MINLEVEL:
+                level = MINLEVEL
+        self.fans[fan].set(level)
+
+    def run(self):
+        try:
+            for fan in self.fans:
+                if fan.mode != FANCTRL_RPM:
+                    fan.logmode()
+            # one scheduler for all RPM control loops, each at its own frequency
+            deadlines = [time()] * len(self.rpmfans)
+            retries = [0] * len(self.rpmfans)
+            while not self.exitevent.is_set() and self.rpmfans:
+                now = time()
+                nextdeadline = now + IDLE_SLEEP
+                for i in range(len(self.rpmfans)):
+                    if now >= deadlines[i]:
+                        self.rpmfans[i].tick()
+                        self._checkstall(i, now, retries)
+                        deadlines[i] += self.rpmfans[i].stime
+                        if deadlines[i] < now:
+                            deadlines[i] = now + self.rpmfans[i].stime
+                    if deadlines[i] < nextdeadline:
+                        nextdeadline = deadlines[i]
+                waittime = nextdeadline - time()
+                if waittime > 0:
+                    self.exitevent.wait(waittime)
+            for fan in self.rpmfans:
+                fan.finish()
+            if self.backup and not self.keep:
+                self.backup.exit()
+        except Exception as e:
+            self.logger.exception(e)
+
+    def _checkstall(self, i, now, retries):
+        fan = self.rpmindex[i]
+        stalled = self.rpmfans[i].stalled()
+        if stalled != (fan in self.failed):
+            self.failover(fan, stalled)
+            retries[i] = now + self.failoverretry
+        elif stalled and now >= retries[i]:
+            self.rpmfans[i].kickstart()
+            retries[i] = now + self.failoverretry
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -12,7 +12,10 @@
 from common.common import common
 from common.stdin import stdin
 from control.pid import pid
+from control.pid2 import pid2
+from control.rls import rls
 from threading import Thread, Event
+from time import time
 from control.autotune import autotune
 from engine.calibrate import calibrate
 #########################################################
@@ -26,7 +29,17 @@ FREQDEFAULT   = 10
 PDEFAULT      = 10
 IDEFAULT      = 1
 MANUAL_SLEEP  = 1
+KICKOFFTIME   = 2 # seconds
+KICKONTIME    = 5 # seconds
 DEFAULTCALPWM = 30
+WEIGHTDEFAULT = 0.5
+DFILTERDEFAULT = 10
+ADAPTMEMORYDEFAULT   = 60 # seconds
+ADAPTINTERVALDEFAULT = 10 # seconds
+ADAPTMINDEFAULT      = 0.25
+ADAPTMAXDEFAULT      = 4.0
+# settings that a profile can switch while running, with their attribute
+PROFILEKEYS   = {'Pgain': 'pgain', 'Igain': 'igain'}
 FANDEBUG      = False
 #########################################################
 
@@ -43,12 +56,29 @@ FANDEBUG      = False
 <Frequency> The frequency of the fan control loop in Hz. default is 10.
 <Pgain> The P gain of the fan control loop. Default is 10. Only used in RPM mode.
 <Igain> The I gain of the fan control loop. Default is 1. Only used in RPM mode.
+<PIDtype> The PID engine of the fan control loop. Default is PID. Only used in RPM mode.
+    PID: PI controller with a clamped integrator.
+    PID2: Two degree of freedom PID controller with setpoint weighting, a filtered derivative on the RPM and
+          back calculation anti windup. Gives less output spikes when the RPM setpoint changes.
+<SetpointWeight> Setpoint weight of the P part (0 .. 1). Default is 0.5. Only used with PID2.
+<Dgain> The D gain of the fan control loop. Default is 0. Only used with PID2.
+<DFilter> Derivative filter N, the derivative is filtered with a time constant of (Dgain/ Pgain)/ N. Default is 10.
+          Only used with PID2.
+<Tracking> Anti windup tracking time constant in seconds. Default is 0 (automatic). Only used with PID2.
+<Slew> Maximum PWM change in % per second. Default is 0 (no limit). Only used with PID2.
+<Adaptive> If true, the PWM to RPM model is estimated while running (recursive least squares) and the PI gains
+           are adapted to it. Only used in RPM mode. Default is false.
+<AdaptMemory> Time in seconds the estimator remembers. Default is 60.
+<AdaptInterval> Minimum time in seconds between gain changes. Default is 10.
+<AdaptMin> Minimum adapted gains as factor of Pgain and Igain. Default is 0.25.
+<AdaptMax> Maximum adapted gains as factor of Pgain and Igain. Default is 4.
 """
 #########################################################
 # Class : fanctrl                                       #
 #########################################################
 class fanctrl(Thread, common):
-    def __init__(self, rpm, fanoutput, mutex, settings, alarm, logger, exitevent, autocal):
+    def __init__(self, rpm, fanoutput, mutex, settings, alarm, logger, exitevent, autocal, state = None, temp = None, threaded = True, fanid = 1,
+                 resume = None):
         self.fanoutput = fanoutput
         self.rpm = rpm
         self.mutex = mutex
@@ -57,18 +87,48 @@ class fanctrl(Thread, common):
         self.exitevent = exitevent
         self.runthread = Event()
         self.runthread.clear()
+        self.running = False
+        self.curalarm = self.alarm.ALARM_NONE
+        self.kicktime = 0
+        # state of a handover to continue from, keep the fan running on exit when handing over
+        self.resume = resume
+        self.keep = False
         common.__init__(self, self.logger)
+        if fanid > 1:
+            self.fanname = "Fan {}".format(fanid)
+        else:
+            self.fanname = "Fan"
         self.mode = FANCTRL_NONE
         self.pid = None
+        self.pidtype = ""
+        self.rls = None
         self.calibrate = None
         mode = self.checkkey(settings, 'fan', 'mode')
         if mode:
             if mode.lower() == "rpm":
                 self.mode = FANCTRL_RPM
-                self.pid = pid()
+                self.pidtype = str(self.checkkeydef(settings, 'fan', 'PIDtype', "PID")).lower()
+                if self.pidtype == "pid2":
+                    self.pid = pid2()
+                    self.weight = self.checkkey(settings, 'fan', 'SetpointWeight')
+                    if self.weight == None:
+                        self.weight = WEIGHTDEFAULT
+                    self.dgain = self.checkkeydef(settings, 'fan', 'Dgain', 0.0)
+                    self.dfilter = self.checkkeydef(settings, 'fan', 'DFilter', DFILTERDEFAULT)
+                    self.tracking = self.checkkeydef(settings, 'fan', 'Tracking', 0.0)
+                    self.slew = self.checkkeydef(settings, 'fan', 'Slew', 0.0)
+                else:
+                    self.pid = pid()
                 self.frequency = self.checkkeydef(settings, 'fan', 'Frequency', FREQDEFAULT)
+                self.stime = 1/self.frequency
                 self.pgain = self.checkkeydef(settings, 'fan', 'Pgain', PDEFAULT)
                 self.igain = self.checkkeydef(settings, 'fan', 'Igain', IDEFAULT)
+                if self.checkkey(settings, 'fan', 'Adaptive'):
+                    self.rls = rls()
+                    self.adaptmemory = self.checkkeydef(settings, 'fan', 'AdaptMemory', ADAPTMEMORYDEFAULT)
+                    self.adaptinterval = self.checkkeydef(settings, 'fan', 'AdaptInterval', ADAPTINTERVALDEFAULT)
+                    self.adaptmin = self.checkkeydef(settings, 'fan', 'AdaptMin', ADAPTMINDEFAULT)
+                    self.adaptmax = self.checkkeydef(settings, 'fan', 'AdaptMax', ADAPTMAXDEFAULT)
             elif mode.lower() == "pwm":
                 self.mode = FANCTRL_PWM
             else:
@@ -76,13 +136,19 @@ class fanctrl(Thread, common):
         else:
             self.mode = FANCTRL_ONOFF
         self.calpwm = self.checkkeydef(settings, 'fan', 'PWMcalibrated', DEFAULTCALPWM)
+        self.startpwm = self.checkkeydef(settings, 'fan', 'PWMstart', 0)
         self.rpmcmd = 0.0
-        self.calibrate = calibrate(self.rpm, self.fanoutput, self.mutex, settings, self.logger, self.exitevent, autocal)
+        self.feedforward = 0.0
+        self.calibrate = calibrate(self.rpm, self.fanoutput, self.mutex, settings, self.logger, self.exitevent, autocal, state, temp, fanid,
+                                   resume != None)
         Thread.__init__(self)
-        Thread.start(self)
+        # if not threaded, the control loop is ticked by a fanbank
+        if threaded:
+            Thread.start(self)
 
     def __del__(self):
         del self.calibrate
+        del self.rls
         del self.pid
 
     def __str__(self):
@@ -111,10 +177,26 @@ class fanctrl(Thread, common):
                 windup = 100.0
             else:
                 windup = 100.0/Ki
+            if self.calibrate.characteristic.valid():
+                # PI only corrects around the feed forward from the PWM to RPM characteristic
+                outputmin = -100.0
+            else:
+                outputmin = 0.001
             self.mutex.acquire()
-            self.pid.updateSettings(Kp = Kp, Ki = Ki, Kd = 0.0, frequency = self.frequency*2,
-                                    direction = 0, sign = 1, outputmin = 0.001, outputmax = 100.0, windup = windup,
-                                    setpoint = 0)
+            if self.pidtype == "pid2":
+                self.pid.updateSettings(Kp = Kp, Ki = Ki, Kd = self.dgain, frequency = self.frequency*2,
+                                        direction = 0, sign = 1, outputmin = outputmin, outputmax = 100.0, windup = windup,
+                                        setpoint = 0, weight = self.weight, filter = self.dfilter, tracking = self.tracking,
+                                        slew = self.slew)
+            else:
+                self.pid.updateSettings(Kp = Kp, Ki = Ki, Kd = 0.0, frequency = self.frequency*2,
+                                        direction = 0, sign = 1, outputmin = outputmin, outputmax = 100.0, windup = windup,
+                                        setpoint = 0)
+            if self.rls:
+                # gains are adapted within bounds around the configured gains
+                self.rls.updateSettings(frequency = self.frequency, memory = self.adaptmemory, interval = self.adaptinterval,
+                                        minfactor = self.adaptmin, maxfactor = self.adaptmax)
+                self.rls.updateGains(Kp = Kp, Ki = Ki)
             self.mutex.release()
         self.runthread.set()
 
@@ -128,40 +210,144 @@ class fanctrl(Thread, common):
     def manualCalibrate(self):
         return self.calibrate.manualCalibrate()
 
+    def recalibrate(self):
+        self.calibrate.trigger()
+
+    def startCalibrate(self):
+        if self.mode == FANCTRL_RPM:
+            return self.calibrate.startCalibrate()
+        print("Automatic start PWM calibration only possible in RPM mode")
+        return 0, 0
+
+    def curveCalibrate(self):
+        if self.mode == FANCTRL_RPM:
+            return self.calibrate.curveCalibrate()
+        print("PWM to RPM characteristic calibration only possible in RPM mode")
+        return False
+
     def run(self):
         try:
             #thread only needs to run in rpm mode
             if self.mode == FANCTRL_RPM:
-                stime = 1/self.frequency
                 while not self.exitevent.is_set():
-                    if self.runthread.is_set():
-                        self.logi("Fan mode: RPM (control started) @ {} Hz".format(self.frequency))
-                        self.pid.clear()
-                        while not self.exitevent.is_set() and self.runthread.is_set():
-                            self.mutex.acquire()
-                            if self.rpmcmd == 0:
-                                self.fanoutput.set(0)
-                                self.pid.clear()
-                            else:
-                                self.fanoutput.set(self.pid.update(self.rpm.get()))
-                            self.getalarm()
-                            self.mutex.release()
-                            self.exitevent.wait(stime)
-                        self.fanoutput.set(0)
-                        self.logi("Fan mode: RPM (control finished)")
+                    if self.tick():
+                        self.exitevent.wait(self.stime)
                     else:
                         self.exitevent.wait(MANUAL_SLEEP)
-            elif self.mode == FANCTRL_PWM:
-                self.logi("Fan mode: PWM")
+                self.finish()
             else:
-                self.logi("Fan mode: ONOFF")
+                self.logmode()
         except Exception as e:
             self.logger.exception(e)
 
+    def tick(self):
+        # Single step of the RPM control loop, returns whether the control loop is running
+        if self.runthread.is_set():
+            if not self.running:
+                self.logi("{} mode: RPM (control started) @ {} Hz".format(self.fanname, self.frequency))
+                self.pid.clear()
+                if self.resume:
+                    if self.resume['pidtype'] == self.pidtype:
+                        self.pid.setstate(self.resume['pid'])
+                    self.rpmcmd = self.resume['rpmcmd']
+                    self.feedforward = self.calibrate.characteristic.getpwm(self.rpmcmd)
+                    self.pid.updateCommand(self.rpmcmd)
+                    self.resume = None
+                self.running = True
+            self.mutex.acquire()
+            kick = time() - self.kicktime
+            if self.rpmcmd == 0:
+                self.fanoutput.set(0)
+                self.pid.clear()
+                self.curalarm = self.getalarm()
+            elif kick < KICKOFFTIME:
+                # kick start retry, switch off first and then run at full power
+                self.fanoutput.set(0)
+            elif kick < KICKOFFTIME + KICKONTIME:
+                self.fanoutput.set(100.0)
+                self.pid.clear()
+            else:
+                self.fanoutput.set(self._output(self.pid.update(self.rpm.get())))
+                if self.rls:
+                    self.adapt()
+                self.curalarm = self.getalarm()
+            self.mutex.release()
+        else:
+            self.finish()
+        return self.running
+
+    def finish(self):
+        if self.running:
+            if not self.keep:
+                self.fanoutput.set(0)
+            self.logi("{} mode: RPM (control finished)".format(self.fanname))
+            self.running = False
+
+    def adapt(self):
+        # Estimate the PWM to RPM model and adapt the PI gains to it
+        self.rls.update(self.rpm.get(), self.fanoutput.get())
+        gains = self.rls.adapt()
+        if gains:
+            Kp, Ki = gains
+            if Ki == 0:
+                windup = 100.0
+            else:
+                windup = 100.0/Ki
+            self.pid.updateGains(Kp = Kp, Ki = Ki, windup = windup)
+            self.logi("{}: PI gains adapted to Kp={:.4g}, Ki={:.4g} (model K={:.4g}, tau={:.3g} s)".format(
+                      self.fanname, Kp, Ki, self.rls.model.gain, self.rls.model.tau))
+
+    def getprofile(self):
+        # Settings that a profile can switch, only the settings used in this mode
+        return {key: getattr(self, attr) for key, attr in PROFILEKEYS.items() if hasattr(self, attr)}
+
+    def setprofile(self, values):
+        # Switch to the settings of a profile while running, the controller keeps its state
+        self.mutex.acquire()
+        changed = [key for key, value in values.items() if getattr(self, PROFILEKEYS[key]) != value]
+        for key in changed:
+            setattr(self, PROFILEKEYS[key], values[key])
+        if changed and self.pid:
+            if self.igain == 0:
+                windup = 100.0
+            else:
+                windup = 100.0/self.igain
+            if self.rls:
+                self.rls.updateGains(Kp = self.pgain, Ki = self.igain)
+            self.pid.updateGains(Kp = self.pgain, Ki = self.igain, windup = windup)
+        self.mutex.release()
+
+    def handover(self):
+        # Keep the fan running at its current level on exit
+        self.keep = True
+
+    def getstate(self):
+        fanstate = {'output': self.fanoutput.get(), 'rpmcmd': self.rpmcmd, 'pidtype': self.pidtype, 'pid': None}
+        if self.pid:
+            fanstate['pid'] = self.pid.getstate()
+        return fanstate
+
+    def stalled(self):
+        return self.curalarm == self.alarm.ALARM_FANNOTRUNNING
+
+    def kickstart(self):
+        if self.mode == FANCTRL_RPM:
+            self.logw("{} stalled, kick start retry".format(self.fanname))
+            self.kicktime = time()
+
+    def logmode(self):
+        if self.mode == FANCTRL_RPM:
+            self.logi("{} mode: RPM".format(self.fanname))
+        elif self.mode == FANCTRL_PWM:
+            self.logi("{} mode: PWM".format(self.fanname))
+        else:
+            self.logi("{} mode: ONOFF".format(self.fanname))
+
     def set(self, value):
         self.mutex.acquire()
         if self.mode == FANCTRL_RPM:
             self.rpmcmd = float(value)
+            self.feedforward = self.calibrate.characteristic.getpwm(self.rpmcmd)
             self.pid.updateCommand(self.rpmcmd)
         elif self.mode == FANCTRL_ONOFF:
             if value:
@@ -172,6 +358,17 @@ class fanctrl(Thread, common):
             self.fanoutput.set(float(value))
         self.mutex.release()
 
+    def _output(self, value):
+        value += self.feedforward
+        if value > 100.0:
+            value = 100.0
+        elif value < 0.001:
+            value = 0.001
+        # kick start a standing fan that will not start at the requested PWM
+        if value < self.startpwm and self.rpm.get() <= 0:
+            value = self.startpwm
+        return value
+
     def get(self):
         value = 0
         if self.mode == FANCTRL_RPM:
@@ -237,7 +434,7 @@ class fanctrl(Thread, common):
         print("Finished manual fan control")
         return
 
-    def RPMautotune(self):
+    def RPMautotune(self, interactive = True):
         self.exitevent.wait(MANUAL_SLEEP)
         inptxt = ""
         if self.mode == FANCTRL_RPM:
@@ -249,7 +446,7 @@ class fanctrl(Thread, common):
             print("No autotuning in ON/ OFF mode possible")
             return False, 0, 0
         piautotune = autotune(self)
-        rv = piautotune.tune()
+        rv = piautotune.tune(interactive)
         del piautotune
         print("Finished autotuning")
         return rv
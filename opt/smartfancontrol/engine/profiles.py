@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : profiles.py                                 #
+#           Switches named setting profiles by time,    #
+#           trigger file, command or condition          #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from common.common import common
+from common.alarms import alarms
+from threading import Thread, Lock
+from time import localtime
+from engine.tempctrl import PROFILEKEYS as ZONEKEYS
+from engine.fanctrl import PROFILEKEYS as FANKEYS
+from hardware.cpufreq import cpufreq
+import os
+#########################################################
+
+####################### GLOBALS #########################
+PROFILEPREFIX  = "profile_"
+PROFILE_SLEEP  = 10 # seconds between activation checks
+PROFILE_AUTO   = "auto"
+PROFILE_NONE   = "none"
+ACTIVATIONKEYS = ("Schedule", "Trigger", "Condition", "Priority")
+CONDITIONS     = ("THROTTLED", "ALARM")
+ALARMPRIO      = alarms.alarmdata[alarms.ALARM_FANNOTRUNNING][0] # stalled fan or temperature alarm
+# all settings of <control> and <fan>, to tell settings that cannot be switched from unknown settings
+CONTROLSETTINGS = ("mode", "TempOn", "TempHyst", "TempStart", "TempFull", "Handoff", "SlewUp", "SlewDown", "Dwell",
+                   "QuietHours", "QuietMax", "LinSteps", "Curve", "CurveFall", "CurveCPU", "CurveHDD", "CurveEXT",
+                   "CurveFallCPU", "CurveFallHDD", "CurveFallEXT", "CurveCombine", "CurveWeights", "Horizon",
+                   "TrendWindow", "Pgain", "Igain", "Adaptive", "AdaptMemory", "AdaptInterval", "AdaptMin", "AdaptMax",
+                   "ThermalGain", "ThermalTau", "ThermalDead", "MPCHorizon", "MPCMoves", "MPCWeight", "MPCSlew",
+                   "LoadGain", "LoadMin", "PSIGain", "ThrottleAvoid", "ThrottleStep", "ThrottleMax", "ThrottleDecay",
+                   "Socket", "Handover", "Frequency", "Fans")
+FANSETTINGS     = ("mode", "PWMgpio", "PWMfrequency", "PWMinvert", "PWMstart", "PWMcalibrated", "RPMgpio", "RPMpullup",
+                   "RPMedge", "RPMppr", "RPMfiltersize", "ONOFFgpio", "ONOFFinvert", "Frequency", "PIDtype", "Pgain",
+                   "Igain", "Dgain", "SetpointWeight", "DFilter", "Tracking", "Slew", "Adaptive", "AdaptMemory",
+                   "AdaptInterval", "AdaptMin", "AdaptMax", "FailoverGpio", "FailoverInvert", "FailoverLevel",
+                   "FailoverRetry", "recalibrate", "recaltemp", "recalload", "recalwindow")
+# all settings and the settings that can be switched per section
+SETTINGS        = {'control': (CONTROLSETTINGS, ZONEKEYS), 'fan': (FANSETTINGS, FANKEYS)}
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+"""
+Profiles:
+<profile_NAME> A named profile, e.g. <profile_night>, that overrides settings while it is active.
+    <control.KEY> Overrides <KEY> of <control> for all zones, e.g. <control.TempStart>50</control.TempStart>.
+    <control2.KEY>, ... Overrides <KEY> for a single zone.
+    <fan.KEY>, <fan2.KEY>, ... Overrides <KEY> of <fan> for all fans or a single fan.
+    Settings that can be switched while running:
+        <control>: TempOn, TempHyst, TempStart, TempFull, Pgain, Igain, LoadGain, LoadMin, PSIGain, SlewUp,
+                   SlewDown, Dwell, QuietMax
+        <fan>: Pgain, Igain
+    <Schedule> Time of the day the profile is active, e.g. 22:00-07:00. Default is empty.
+    <Trigger> The profile is active while this file exists, e.g. /run/smartfancontrol.night. Default is empty.
+    <Condition> The profile is active during a condition. Default is empty.
+        THROTTLED: The CPU is throttled.
+        ALARM: A fan stalled or a temperature alarm is active.
+    <Priority> If multiple profiles are active, the profile with the highest priority is used. Default is 0.
+The values of all profiles are merged with the settings when the daemon starts. Switching a profile only
+changes these values, the controllers continue from their current state. Activation is checked every 10 s.
+"""
+
+def hasprofiles(settings):
+    return any(group.startswith(PROFILEPREFIX) for group in settings)
+
+#########################################################
+# Class : profiles                                      #
+#########################################################
+class profiles(Thread, common):
+    def __init__(self, settings, tempctrls, fanctrls, alarm, logger, exitevent):
+        self.tempctrls = tempctrls
+        self.fanctrls = fanctrls
+        self.alarm = alarm
+        self.logger = logger
+        self.exitevent = exitevent
+        common.__init__(self, self.logger)
+        self.mutex = Lock()
+        self.cpufreq = None
+        self.forced = None
+        self.active = ""
+        self.activation = {}
+        # values of every zone and fan per profile, "" are the settings without profile
+        basezones = [zonectrl.getprofile() for zonectrl in self.tempctrls]
+        basefans = [fan.getprofile() for fan in self.fanctrls]
+        self.zonevalues = {"": basezones}
+        self.fanvalues = {"": basefans}
+        for group in settings:
+            if group.startswith(PROFILEPREFIX):
+                name = group[len(PROFILEPREFIX):]
+                if not name or name.lower() in (PROFILE_AUTO, PROFILE_NONE):
+                    self.loge("Invalid profile name: {}, profile not used".format(group))
+                    continue
+                overrides = self.getoverrides(name, settings, group)
+                for section, index in overrides:
+                    if index > len(basezones if section == 'control' else basefans):
+                        self.logw("Profile {}: {}{} does not exist, ignored".format(name, section, index))
+                self.activation[name] = self.getactivation(name, settings, group)
+                self.zonevalues[name] = self.getvalues(overrides, 'control', basezones)
+                self.fanvalues[name] = self.getvalues(overrides, 'fan', basefans)
+                for zonectrl, values in zip(self.tempctrls, self.zonevalues[name]):
+                    zonectrl.prepareprofile(values)
+        # highest priority first
+        self.order = sorted(self.activation, key = lambda name: (-self.activation[name]['priority'], name))
+        if any("THROTTLED" in self.activation[name]['condition'] for name in self.order):
+            if self.tempctrls[0].cpufreq:
+                self.cpufreq = self.tempctrls[0].cpufreq
+            else:
+                self.cpufreq = cpufreq(self.logger)
+                if not self.cpufreq.available():
+                    self.cpufreq = None
+        self.owncpufreq = self.cpufreq != None and self.cpufreq != self.tempctrls[0].cpufreq
+        Thread.__init__(self)
+        Thread.start(self)
+
+    def __del__(self):
+        del self.cpufreq
+
+    def run(self):
+        try:
+            while not self.exitevent.is_set():
+                self.select()
+                self.exitevent.wait(PROFILE_SLEEP)
+        except Exception as e:
+            self.logger.exception(e)
+
+    def select(self):
+        # Switch to the forced profile or the active profile with the highest priority
+        self.mutex.acquire()
+        name = self.forced
+        if name == None:
+            name = ""
+            clock = localtime()
+            minute = clock.tm_hour * 60 + clock.tm_min
+            for profile in self.order:
+                if self.isactive(profile, minute):
+                    name = profile
+                    break
+        if name != self.active:
+            self.apply(name)
+        self.mutex.release()
+
+    def isactive(self, name, minute):
+        activation = self.activation[name]
+        if activation['schedule'] and self.inperiod(activation['schedule'], minute):
+            return True
+        if activation['trigger'] and os.path.exists(activation['trigger']):
+            return True
+        if "THROTTLED" in activation['condition'] and self.cpufreq:
+            if self.owncpufreq:
+                self.cpufreq.update()
+            if self.cpufreq.throttled:
+                return True
+        if "ALARM" in activation['condition']:
+            alm = self.alarm.getprio()
+            if self.alarm.alarmdata[alm][0] >= ALARMPRIO:
+                return True
+        return False
+
+    def apply(self, name):
+        # Switch all zones and fans to the precomputed values of the profile
+        for zonectrl, values in zip(self.tempctrls, self.zonevalues[name]):
+            zonectrl.setprofile(values)
+        for fan, values in zip(self.fanctrls, self.fanvalues[name]):
+            fan.setprofile(values)
+        self.active = name
+        if name:
+            self.logi("Profile {} active".format(name))
+        else:
+            self.logi("No profile active")
+
+    def getactivation(self, name, settings, group):
+        activation = {'schedule': None, 'trigger': None, 'condition': (), 'priority': 0}
+        if self.checkkey(settings, group, 'Schedule'):
+            try:
+                activation['schedule'] = self.parseperiod(settings[group]['Schedule'])
+            except ValueError:
+                self.loge("Invalid schedule for profile {}, schedule not used".format(name))
+        if self.checkkey(settings, group, 'Trigger'):
+            activation['trigger'] = str(settings[group]['Trigger'])
+        if self.checkkey(settings, group, 'Condition'):
+            conditions = []
+            for condition in str(settings[group]['Condition']).upper().split(","):
+                if condition.strip() in CONDITIONS:
+                    conditions.append(condition.strip())
+                elif condition.strip():
+                    self.loge("Invalid condition {} for profile {}, condition not used".format(condition.strip(), name))
+            activation['condition'] = tuple(conditions)
+        priority = self.checkkeydef(settings, group, 'Priority', 0)
+        if type(priority) in (int, float) and type(priority) != bool:
+            activation['priority'] = priority
+        else:
+            self.loge("Invalid priority for profile {}, priority 0 used".format(name))
+        return activation
+
+    def getoverrides(self, name, settings, group):
+        # Overrides as {(section, index): {key: value}}, index 0 is every zone or fan
+        overrides = {}
+        for key, value in settings[group].items():
+            if key in ACTIVATIONKEYS:
+                continue
+            target, sep, param = key.partition(".")
+            section = target.rstrip("0123456789")
+            index = int(target[len(section):] or 0)
+            if not section in SETTINGS or not param in SETTINGS[section][0]:
+                self.logw("Profile {}: unknown setting {}, ignored".format(name, key))
+            elif not param in SETTINGS[section][1]:
+                self.logw("Profile {}: {} cannot be switched while running, ignored".format(name, key))
+            elif type(value) == bool or not type(value) in (int, float):
+                self.logw("Profile {}: invalid value for {}, ignored".format(name, key))
+            else:
+                overrides.setdefault((section, index), {})[param] = value
+        return overrides
+
+    def getvalues(self, overrides, section, base):
+        # Values of every zone or fan: base values, overridden by <section.KEY> and then by <sectionN.KEY>
+        values = []
+        for i in range(len(base)):
+            merged = dict(base[i])
+            for index in (0, i + 1):
+                for param, value in overrides.get((section, index), {}).items():
+                    # settings that are not used in the mode of the zone or fan are not switched
+                    if param in merged:
+                        merged[param] = value
+            values.append(merged)
+        return values
+
+    def profile_cmd(self, args):
+        if args:
+            name = args[0]
+            if name.lower() == PROFILE_AUTO:
+                self.forced = None
+            elif name.lower() == PROFILE_NONE:
+                self.forced = ""
+            elif name in self.activation:
+                self.forced = name
+            else:
+                return "ERROR unknown profile: {}".format(name)
+            self.select()
+        mode = "auto"
+        if self.forced != None:
+            mode = "forced"
+        return "profile={} mode={}".format(self.active or PROFILE_NONE, mode)
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -13,9 +13,22 @@ from common.common import common
 from control.onoff import onoff
 from control.linear import linear
 from control.pid import pid
+from control.curve import curve
+from control.multicurve import multicurve, COMBINE_MAX, COMBINE_WEIGHTED
 from threading import Thread, Event, Lock
+from time import time, localtime
 from common.stdin import stdin
 from common.monitor import monitor
+from control.fopdt import fopdt
+from control.predict import predict
+from control.mpc import mpc
+from control.rls import rls
+from control.shaper import shaper
+from control.leases import leases, LEASE_BOOST, LEASE_CAP
+from math import log, isfinite
+from hardware.temp import ABS_NULL
+from hardware.load import load
+from hardware.cpufreq import cpufreq
 #########################################################
 
 ####################### GLOBALS #########################
@@ -23,6 +36,8 @@ TEMPCTRL_NONE    = 0
 TEMPCTRL_ONOFF   = 1
 TEMPCTRL_LINEAR  = 2
 TEMPCTRL_PI      = 3
+TEMPCTRL_CURVE   = 4
+TEMPCTRL_MPC     = 5
 TEMPONDEFAULT    = 55
 TEMPHYSTDEFAULT  = 5
 FANSTARTDEFAULT  = 20
@@ -33,6 +48,36 @@ TFREQDEFAULT     = 1
 TPDEFAULT        = 10
 TIDEFAULT        = 1
 IDLE_SLEEP       = 1
+HANDOFFDEFAULT   = 10 # seconds to ramp over the full fan range
+QUIETMAXDEFAULT  = 50 # % of fan range
+LEASEMAXTIME     = 86400 # seconds
+REGION_IDLE      = 0
+REGION_CONTROL   = 1
+REGION_FULL      = 2
+SENSORS          = ("CPU", "HDD", "EXT")
+TRENDWINDOWDEFAULT = 30
+LOADMINDEFAULT   = 50
+THROTTLESTEPDEFAULT  = 2
+THROTTLEMAXDEFAULT   = 10
+THROTTLEDECAYDEFAULT = 1
+THROTTLEHOLD     = 60 # seconds throttled before the next step
+ALARMHIGHDEFAULT = 65
+MPCMOVESDEFAULT  = 3
+MPCWEIGHTDEFAULT = 0.1
+MPCSLEWDEFAULT   = 10 # % of fan range per second
+ADAPTMEMORYDEFAULT   = 3600 # seconds
+ADAPTINTERVALDEFAULT = 300  # seconds
+ADAPTMINDEFAULT      = 0.25
+ADAPTMAXDEFAULT      = 4.0
+# settings that a profile can switch while running, with their attribute
+PROFILEKEYS      = {'TempOn': 'tempon', 'TempHyst': 'temphyst', 'TempStart': 'tempstart', 'TempFull': 'tempfull',
+                    'Pgain': 'pgain', 'Igain': 'igain', 'LoadGain': 'loadgain', 'LoadMin': 'loadmin', 'PSIGain': 'psigain',
+                    'SlewUp': 'slewup', 'SlewDown': 'slewdown', 'Dwell': 'dwell', 'QuietMax': 'quietmax'}
+DTRMN_SLEEP      = 1    # seconds
+DTRMN_SETTLE     = 900  # maximum settle time [s]
+DTRMN_LENGTH     = 1200 # maximum step response time [s]
+DTRMN_WINDOW     = 120  # temperature is steady if it changes less than DTRMN_STEADY in this time [s]
+DTRMN_STEADY     = 0.5
 #########################################################
 
 ###################### FUNCTIONS ########################
@@ -46,6 +91,9 @@ ONOFF: Only on/ off control is used, if this mode is selected, on/off control wi
 LINEAR: If the temperature is within the linear range, the fan speed will increase linear with a
     	temperature increase.
 PI: PI temperature control is used.
+CURVE: The fan speed follows a curve of (temperature, fan %) points, interpolated between the points.
+MPC: Model predictive temperature control on the identified thermal model (ThermalGain, ThermalTau, ThermalDead).
+     Run -d first, otherwise PI control is used.
 <TempOn> The temperature to switch the fan on. Default is 55 Celcius in ONOFF mode.
          In other modes this is the idle running temperature (minimum RPM or PWM). Set > TempStart if not used.
          If Farenheit is selected, then this temperature is in Farenheit
@@ -60,6 +108,53 @@ PI: PI temperature control is used.
 <Frequency> The frequency of the temperature control loop in Hz. default is 1.
 <Pgain> The P gain of the temperature control loop. Default is 10. Only used in PI mode.
 <Igain> The I gain of the temperature control loop. Default is 1. Only used in PI mode.
+<Curve> The fan curve as temperature:fan% points, e.g. 40:0,45:20,55:50,65:100. Only used in CURVE mode.
+        Fan % is the percentage of the range between minimum and maximum fan speed, 0 is off.
+<CurveFall> Optional fan curve used when the temperature falls, in the same format as <Curve>.
+            Should be at or below <Curve> for hysteresis. Only used in CURVE mode.
+<CurveCPU>, <CurveHDD>, <CurveEXT> Optional fan curve for a single sensor, in the same format as <Curve>.
+            If one of them is entered, every sensor has its own curve (<Curve> for sensors without own curve)
+            and the fan demands are combined. Only used in CURVE mode.
+<CurveFallCPU>, <CurveFallHDD>, <CurveFallEXT> Optional falling fan curve for a single sensor. Only used in CURVE mode.
+<CurveCombine> How sensor fan demands are combined. Default is MAX. Only used with sensor curves.
+    MAX: Use the maximum fan demand of all sensors.
+    WEIGHTED: Use the weighted average fan demand of all sensors.
+<CurveWeights> Weights for WEIGHTED combining, e.g. CPU:1,HDD:2,EXT:1. Default is 1 for every sensor.
+<Handoff> Time in seconds to ramp over the full fan range when the controller changes between idle (below TempStart),
+          control and full speed (above TempFull). Default is 10, 0 is no ramp. In PI and MPC mode, the controller
+          continues from the current fan speed and only returns to idle below TempStart - TempHyst.
+<SlewUp> Maximum fan speed increase in % of the fan range per second. Default is 0 (no limit).
+<SlewDown> Maximum fan speed decrease in % of the fan range per second. Default is 0 (no limit).
+<Dwell> Minimum time in seconds at a fan speed before it starts changing again or changes direction.
+        Default is 0. Changes to full speed are never delayed.
+<QuietHours> Time of the day to limit the fan speed, e.g. 22:00-07:00. Default is empty (not used).
+<QuietMax> Maximum fan speed in quiet hours in % of the fan range. Default is 50. Above TempFull, the
+           fan speed is not limited.
+<Adaptive> If true, the thermal model is estimated while running (recursive least squares) and the PI gains
+           are adapted to it. Only used in PI mode. Default is false.
+<AdaptMemory> Time in seconds the estimator remembers. Default is 3600.
+<AdaptInterval> Minimum time in seconds between gain changes. Default is 300.
+<AdaptMin> Minimum adapted gains as factor of Pgain and Igain. Default is 0.25.
+<AdaptMax> Maximum adapted gains as factor of Pgain and Igain. Default is 4.
+<MPCHorizon> Prediction horizon in seconds. Default is 0 (ThermalTau + ThermalDead). Only used in MPC mode.
+<MPCMoves> Number of fan moves optimized over the horizon. Default is 3. Only used in MPC mode.
+<MPCWeight> Move suppression. Higher values give less fan speed changes and slower control. Default is 0.1.
+            Only used in MPC mode.
+<MPCSlew> Maximum fan speed change in % of the fan range per second. Default is 10. Only used in MPC mode.
+<Horizon> Time in seconds to look ahead. If larger than 0, the controller uses the temperature predicted from
+          the temperature trend if it is higher than the actual temperature. Default is 0 (no prediction).
+<TrendWindow> Time in seconds used to determine the temperature trend. Default is 30.
+<LoadGain> Fan % added per % CPU load above <LoadMin>, to start cooling before the temperature rises.
+           Default is 0 (no load feed forward).
+<LoadMin> CPU load in % above which the load feed forward starts. Default is 50.
+<PSIGain> Fan % added per % CPU pressure (time tasks wait for a CPU). Default is 0 (no pressure feed forward).
+<ThrottleAvoid> Avoid CPU throttling. Default is false. On every throttle event (and every minute throttling
+                continues) the temperature offset is increased by <ThrottleStep>, up to <ThrottleMax>.
+                The offset is added to the measured temperature, so the fan runs earlier and faster.
+                Without throttling, the offset decreases by <ThrottleDecay> per hour.
+<ThrottleStep> Temperature offset step on throttling. Default is 2 Celcius.
+<ThrottleMax> Maximum temperature offset. Default is 10 Celcius.
+<ThrottleDecay> Decrease of the temperature offset per hour without throttling. Default is 1 Celcius.
 """
 
 
@@ -67,7 +162,7 @@ PI: PI temperature control is used.
 # Class : tempctrl                                      #
 #########################################################
 class tempctrl(Thread, common):
-    def __init__(self, fanctrl, temp, settings, alarm, logger, exitevent, monstatus):
+    def __init__(self, fanctrl, temp, settings, alarm, logger, exitevent, monstatus, zoneid = 1, resume = None):
         self.fanctrl = fanctrl
         self.temp = temp
         self.alarm = alarm
@@ -77,13 +172,51 @@ class tempctrl(Thread, common):
         self.runthread.clear()
         self.mutex = Lock()
         common.__init__(self, self.logger)
+        self.zoneid = zoneid
+        # state of a handover to continue from, keep the fans running on exit when handing over
+        self.resume = resume
+        self.keep = False
+        if zoneid > 1:
+            self.zonename = "Zone {} temperature control".format(zoneid)
+        else:
+            self.zonename = "Temperature control"
         self.mode = TEMPCTRL_NONE
         self.pid = None
+        self.rls = None
+        self.mpc = None
         self.linear = None
         self.onoff = None
+        self.curve = None
+        self.multicurve = None
         self.frequency = self.checkkeydef(settings, 'control', 'Frequency', TFREQDEFAULT)
         self.tempstart = self.checkkeydef(settings, 'control', 'TempStart', TEMPSTARTDEFAULT)
         self.tempfull = self.checkkeydef(settings, 'control', 'TempFull', TEMPFULLDEFUALT)
+        self.predict = None
+        self.horizon = self.checkkeydef(settings, 'control', 'Horizon', 0)
+        self.trendwindow = self.checkkeydef(settings, 'control', 'TrendWindow', TRENDWINDOWDEFAULT)
+        if self.horizon > 0:
+            self.predict = predict()
+        self.load = None
+        self.loadgain = self.checkkeydef(settings, 'control', 'LoadGain', 0)
+        self.loadmin = self.checkkeydef(settings, 'control', 'LoadMin', LOADMINDEFAULT)
+        self.psigain = self.checkkeydef(settings, 'control', 'PSIGain', 0)
+        if self.loadgain > 0 or self.psigain > 0:
+            self.load = load(self.logger)
+        self.trend = None
+        self.headroomstr = ""
+        self.thermalgain = self.checkkeydef(settings, 'control', 'ThermalGain', 0.0)
+        self.thermaltau = self.checkkeydef(settings, 'control', 'ThermalTau', 0.0)
+        self.thermaldead = self.checkkeydef(settings, 'control', 'ThermalDead', 0.0)
+        self.cpufreq = None
+        self.throttleoffset = 0.0
+        self.throttletime = 0.0
+        self.throttlestep = self.checkkeydef(settings, 'control', 'ThrottleStep', THROTTLESTEPDEFAULT)
+        self.throttlemax = self.checkkeydef(settings, 'control', 'ThrottleMax', THROTTLEMAXDEFAULT)
+        self.throttledecay = self.checkkeydef(settings, 'control', 'ThrottleDecay', THROTTLEDECAYDEFAULT)
+        if self.checkkey(settings, 'control', 'ThrottleAvoid'):
+            self.cpufreq = cpufreq(self.logger)
+            if not self.cpufreq.available():
+                self.cpufreq = None
         mode = self.checkkey(settings, 'control', 'mode')
         if mode:
             if mode.lower() == "pi":
@@ -97,22 +230,97 @@ class tempctrl(Thread, common):
                 self.linear = linear()
                 self.linsteps = self.checkkeydef(settings, 'control', 'LinSteps', LINSTEPSDEFUALT)
                 self.onoff = onoff()
+            elif mode.lower() == "curve":
+                self.mode = TEMPCTRL_CURVE
+                self.curve = curve()
+                try:
+                    self.curvepoints = self.curve.parse(self.checkkey(settings, 'control', 'Curve'))
+                    self.curvefallpoints = []
+                    if self.checkkey(settings, 'control', 'CurveFall') != None:
+                        self.curvefallpoints = self.curve.parse(self.checkkey(settings, 'control', 'CurveFall'))
+                    self.sensorcurves = self.getsensorcurves(settings)
+                except ValueError:
+                    self.loge("Invalid fan curve, using ONOFF mode")
+                    self.mode = TEMPCTRL_ONOFF
+                    self.curve = None
+                    self.onoff = onoff()
+            elif mode.lower() == "mpc":
+                self.onoff = onoff()
+                if self.thermalgain < 0 and self.thermaltau > 0:
+                    self.mode = TEMPCTRL_MPC
+                    self.mpc = mpc()
+                    self.mpchorizon = self.checkkeydef(settings, 'control', 'MPCHorizon', 0)
+                    self.mpcmoves = self.checkkeydef(settings, 'control', 'MPCMoves', MPCMOVESDEFAULT)
+                    self.mpcweight = self.checkkeydef(settings, 'control', 'MPCWeight', MPCWEIGHTDEFAULT)
+                    self.mpcslew = self.checkkeydef(settings, 'control', 'MPCSlew', MPCSLEWDEFAULT)
+                else:
+                    self.loge("No thermal model for MPC mode (run -d), using PI mode")
+                    self.mode = TEMPCTRL_PI
+                    self.pid = pid()
+                    self.pgain = self.checkkeydef(settings, 'control', 'Pgain', TPDEFAULT)
+                    self.igain = self.checkkeydef(settings, 'control', 'Igain', TIDEFAULT)
             else:
                 self.mode = TEMPCTRL_ONOFF
                 self.onoff = onoff()
         else:
             self.mode = TEMPCTRL_ONOFF
             self.onoff = onoff()
+        if self.mode == TEMPCTRL_PI and self.checkkey(settings, 'control', 'Adaptive'):
+            self.rls = rls()
+            self.adaptmemory = self.checkkeydef(settings, 'control', 'AdaptMemory', ADAPTMEMORYDEFAULT)
+            self.adaptinterval = self.checkkeydef(settings, 'control', 'AdaptInterval', ADAPTINTERVALDEFAULT)
+            self.adaptmin = self.checkkeydef(settings, 'control', 'AdaptMin', ADAPTMINDEFAULT)
+            self.adaptmax = self.checkkeydef(settings, 'control', 'AdaptMax', ADAPTMAXDEFAULT)
+        self.handoff = self.checkkeydef(settings, 'control', 'Handoff', HANDOFFDEFAULT)
+        if self.checkkey(settings, 'control', 'Handoff') == 0:
+            self.handoff = 0
+        self.region = REGION_IDLE
+        self.ramping = False
+        self.lastout = 0.0
+        self.shaper = None
+        self.slewup = self.checkkeydef(settings, 'control', 'SlewUp', 0)
+        self.slewdown = self.checkkeydef(settings, 'control', 'SlewDown', 0)
+        self.dwell = self.checkkeydef(settings, 'control', 'Dwell', 0)
+        self.quiet = None
+        self.quietmax = self.checkkeydef(settings, 'control', 'QuietMax', QUIETMAXDEFAULT)
+        self.quietcheck = 0.0
+        self.quietcap = None
+        self.quietactive = False
+        self.tempval = ABS_NULL
+        self.leases = None
+        self.leaseboost = None
+        self.leaseoffset = 0.0
+        if self.checkkey(settings, 'control', 'QuietHours'):
+            try:
+                self.quiet = self.parseperiod(self.checkkey(settings, 'control', 'QuietHours'))
+            except ValueError:
+                self.loge("Invalid quiet hours, quiet hours not used")
+        if self.slewup > 0 or self.slewdown > 0 or self.dwell > 0 or self.quiet:
+            self.shaper = shaper()
         self.tempon = self.checkkeydef(settings, 'control', 'TempOn', TEMPONDEFAULT)
         self.temphyst = self.checkkeydef(settings, 'control', 'TempHyst', TEMPHYSTDEFAULT)
-        self.monitor = monitor(fanctrl, temp, self.mutex, alarm, logger, exitevent, monstatus)
+        # only the first zone is monitored
+        self.monitor = None
+        if zoneid == 1:
+            self.monitor = monitor(fanctrl, temp, self.mutex, alarm, logger, exitevent, monstatus)
+            if self.cpufreq or self.shaper:
+                self.monitor.addmetrics(self)
         Thread.__init__(self)
         Thread.start(self)
 
     def __del__(self):
         del self.monitor
+        del self.leases
+        del self.shaper
+        del self.predict
+        del self.load
+        del self.cpufreq
+        del self.multicurve
+        del self.curve
         del self.onoff
         del self.linear
+        del self.mpc
+        del self.rls
         del self.pid
 
     def start(self, Kp = -100000, Ki = -100000):
@@ -131,6 +339,20 @@ class tempctrl(Thread, common):
                                     setpoint = self.tempstart)
             self.onoff.updateSettings(frequency = self.frequency*2, outputmin = 0, outputmax = self.fanctrl.min(),
                                       hysteresis = self.temphyst, setpoint = self.tempon)
+            if self.rls:
+                # gains are adapted within bounds around the configured gains
+                self.rls.updateSettings(frequency = self.frequency, memory = self.adaptmemory, deadtime = self.thermaldead,
+                                        interval = self.adaptinterval, minfactor = self.adaptmin, maxfactor = self.adaptmax, sign = -1)
+                self.rls.updateGains(Kp = Kp, Ki = Ki)
+            self.mutex.release()
+        elif self.mode == TEMPCTRL_MPC:
+            self.mutex.acquire()
+            self.mpc.updateSettings(frequency = self.frequency, gain = self.thermalgain, tau = self.thermaltau, deadtime = self.thermaldead,
+                                    horizon = self.mpchorizon, moves = self.mpcmoves, weight = self.mpcweight,
+                                    outputmin = self.fanctrl.min(), outputmax = self.fanctrl.max(),
+                                    slew = (self.fanctrl.max() - self.fanctrl.min()) * self.mpcslew / 100.0, setpoint = self.tempstart)
+            self.onoff.updateSettings(frequency = self.frequency*2, outputmin = 0, outputmax = self.fanctrl.min(),
+                                      hysteresis = self.temphyst, setpoint = self.tempon)
             self.mutex.release()
         elif self.mode == TEMPCTRL_LINEAR:
             self.mutex.acquire()
@@ -139,20 +361,49 @@ class tempctrl(Thread, common):
             self.onoff.updateSettings(frequency = self.frequency*2, outputmin = 0, outputmax = self.fanctrl.min(),
                                       hysteresis = self.temphyst, setpoint = self.tempon)
             self.mutex.release()
+        elif self.mode == TEMPCTRL_CURVE:
+            self.mutex.acquire()
+            self.curve.updateSettings(frequency = self.frequency*2, outputmin = self.fanctrl.min(), outputmax = self.fanctrl.max(),
+                                      points = self.curvepoints, fallpoints = self.curvefallpoints)
+            if self.multicurve:
+                for i in range(len(SENSORS)):
+                    self.multicurve.updateSettings(i, frequency = self.frequency*2, outputmin = self.fanctrl.min(), outputmax = self.fanctrl.max(),
+                                                   points = self.sensorcurves[i][0], fallpoints = self.sensorcurves[i][1], weight = self.sensorcurves[i][2])
+            self.mutex.release()
         else: # TEMPCTRL_ONOFF
             self.mutex.acquire()
             self.onoff.updateSettings(frequency = self.frequency*2, outputmin = self.fanctrl.min(), outputmax = self.fanctrl.max(),
                                       hysteresis = self.temphyst, setpoint = self.tempon)
             self.mutex.release()
+        if self.shaper:
+            self.mutex.acquire()
+            fanrange = (self.fanctrl.max() - self.fanctrl.min()) / 100.0
+            self.shaper.updateSettings(outputmin = self.fanctrl.min(), outputmax = self.fanctrl.max(), slewup = self.slewup * fanrange,
+                                       slewdown = self.slewdown * fanrange, dwell = self.dwell)
+            if self.quiet:
+                self.quietcheck = 0.0
+                self.quietcap = self.fanctrl.min() + self.quietmax * fanrange
+            self.mutex.release()
+        if self.predict:
+            self.mutex.acquire()
+            self.predict.updateSettings(frequency = self.frequency, horizon = self.horizon, window = self.trendwindow)
+            self.mutex.release()
+        if self.trend and self.trend != self.predict:
+            self.mutex.acquire()
+            self.trend.updateSettings(frequency = self.frequency, horizon = 0.0, window = self.trendwindow)
+            self.mutex.release()
         self.runthread.set()
-        self.monitor.start()
+        if self.monitor:
+            self.monitor.start()
 
     def stop(self):
-        self.monitor.stop()
+        if self.monitor:
+            self.monitor.stop()
         self.runthread.clear()
 
     def exit(self):
-        self.monitor.exit()
+        if self.monitor:
+            self.monitor.exit()
         self.exitevent.set()
 
     def run(self):
@@ -161,64 +412,549 @@ class tempctrl(Thread, common):
             while not self.exitevent.is_set():
                 if self.runthread.is_set():
                     if self.mode == TEMPCTRL_PI:
-                        self.logi("Temperature control: PI (control started) @ {} Hz".format(self.frequency))
+                        self.logi("{}: PI (control started) @ {} Hz".format(self.zonename, self.frequency))
                         self.pid.clear()
+                        self.clearRegion()
+                        self.resumeState()
                         while not self.exitevent.is_set() and self.runthread.is_set():
                             self.mutex.acquire()
                             self.temp.update()
-                            if self.temp.get() < self.tempstart:
-                                if self.tempon < self.tempstart:
-                                    self.fanctrl.set(self.onoff.update(self.temp.get()))
-                                else:
-                                    self.fanctrl.set(0)
-                                self.pid.clear()
-                            elif self.temp.get() > self.tempfull:
-                                self.fanctrl.set(self.fanctrl.max())
-                                self.pid.clear()
+                            tempval = self.feedback()
+                            region = self.getRegion(tempval)
+                            if region == REGION_IDLE:
+                                value = self.idle(tempval)
+                            elif region == REGION_FULL:
+                                value = self.fanctrl.max()
                             else:
-                                self.fanctrl.set(self.pid.update(self.temp.get()))
+                                if self.region != REGION_CONTROL:
+                                    # continue from the current fan speed
+                                    self.pid.bumpless(self.lastout, tempval)
+                                value = self.pid.update(tempval)
+                                if self.rls:
+                                    self.adapt()
+                            self.region = region
+                            self.fanctrl.set(self.output(self.ramp(value)))
                             self.mutex.release()
                             self.exitevent.wait(stime)
-                        self.fanctrl.set(0)
-                        self.logi("Temperature control: PI (control finished)")
+                        if not self.keep:
+                            self.fanctrl.set(0)
+                        self.logi("{}: PI (control finished)".format(self.zonename))
+                    elif self.mode == TEMPCTRL_MPC:
+                        self.logi("{}: MPC (control started) @ {} Hz".format(self.zonename, self.frequency))
+                        self.mpc.clear()
+                        self.clearRegion()
+                        self.resumeState()
+                        while not self.exitevent.is_set() and self.runthread.is_set():
+                            self.mutex.acquire()
+                            self.temp.update()
+                            tempval = self.feedback()
+                            region = self.getRegion(tempval)
+                            if region == REGION_IDLE:
+                                value = self.idle(tempval)
+                            elif region == REGION_FULL:
+                                value = self.fanctrl.max()
+                            else:
+                                if self.region != REGION_CONTROL:
+                                    # continue from the current fan speed
+                                    self.mpc.clear(max(self.lastout, self.fanctrl.min()))
+                                value = self.mpc.update(tempval)
+                            self.region = region
+                            self.fanctrl.set(self.output(self.ramp(value)))
+                            self.mutex.release()
+                            self.exitevent.wait(stime)
+                        if not self.keep:
+                            self.fanctrl.set(0)
+                        self.logi("{}: MPC (control finished)".format(self.zonename))
                     elif self.mode == TEMPCTRL_LINEAR:
-                        self.logi("Temperature control: LINEAR (control started) @ {} Hz".format(self.frequency))
+                        self.logi("{}: LINEAR (control started) @ {} Hz".format(self.zonename, self.frequency))
                         self.linear.clear()
+                        self.clearRegion()
+                        self.resumeState()
                         while not self.exitevent.is_set() and self.runthread.is_set():
                             self.mutex.acquire()
                             self.temp.update()
-                            if self.tempon < self.tempstart and self.temp.get() < self.tempstart:
-                                self.fanctrl.set(self.onoff.update(self.temp.get()))
+                            tempval = self.feedback()
+                            if self.tempon < self.tempstart and tempval < self.tempstart:
+                                region = REGION_IDLE
+                                value = self.onoff.update(tempval)
                             else:
-                                self.fanctrl.set(self.linear.update(self.temp.get()))
+                                region = REGION_CONTROL
+                                if tempval > self.tempfull:
+                                    # full speed is not ramped
+                                    region = REGION_FULL
+                                value = self.linear.update(tempval)
+                            if region != self.region:
+                                self.ramping = True
+                            self.region = region
+                            self.fanctrl.set(self.output(self.ramp(value)))
                             self.mutex.release()
                             self.exitevent.wait(stime)
-                        self.fanctrl.set(0)
-                        self.logi("Temperature control: LINEAR (control finished)")
+                        if not self.keep:
+                            self.fanctrl.set(0)
+                        self.logi("{}: LINEAR (control finished)".format(self.zonename))
+                    elif self.mode == TEMPCTRL_CURVE:
+                        self.logi("{}: CURVE (control started) @ {} Hz".format(self.zonename, self.frequency))
+                        self.curve.clear()
+                        if self.multicurve:
+                            self.multicurve.clear()
+                        while not self.exitevent.is_set() and self.runthread.is_set():
+                            self.mutex.acquire()
+                            self.temp.update()
+                            tempval = self.feedback()
+                            if self.multicurve:
+                                self.fanctrl.set(self.output(self.multicurve.update(self.feedbacksensors())))
+                            else:
+                                self.fanctrl.set(self.output(self.curve.update(tempval)))
+                            self.mutex.release()
+                            self.exitevent.wait(stime)
+                        if not self.keep:
+                            self.fanctrl.set(0)
+                        self.logi("{}: CURVE (control finished)".format(self.zonename))
                     else:
-                        self.logi("Temperature control: ONOFF (control started) @ {} Hz".format(self.frequency))
+                        self.logi("{}: ONOFF (control started) @ {} Hz".format(self.zonename, self.frequency))
                         self.onoff.clear()
                         while not self.exitevent.is_set() and self.runthread.is_set():
                             self.mutex.acquire()
                             self.temp.update()
-                            self.fanctrl.set(self.onoff.update(self.temp.get()))
+                            tempval = self.feedback()
+                            self.fanctrl.set(self.output(self.onoff.update(tempval)))
                             self.mutex.release()
                             self.exitevent.wait(stime)
-                        self.fanctrl.set(0)
-                        self.logi("Temperature control: ONOFF (control finished)")
+                        if not self.keep:
+                            self.fanctrl.set(0)
+                        self.logi("{}: ONOFF (control finished)".format(self.zonename))
                 else:
                     self.exitevent.wait(IDLE_SLEEP)
         except Exception as e:
             self.logger.exception(e)
 
-    def determine(self):
-        stdinput = stdin("", exitevent = self.fanctrl.exitevent)
+    def feedback(self):
+        # Temperature used by the controllers, once per control loop
+        tempval = self.temp.get()
+        if self.trend:
+            self.updateHeadroom(tempval)
+        if self.predict:
+            if tempval > ABS_NULL:
+                projected = self.predict.update(tempval)
+                # only look ahead to cool earlier, never to delay cooling
+                if projected > tempval:
+                    tempval = projected
+            else:
+                self.predict.clear()
+        if self.cpufreq:
+            self.throttle()
+            if tempval > ABS_NULL:
+                tempval += self.throttleoffset
+        if self.leases:
+            self.leaseboost, cap = self.leases.update()
+            # a lower temperature target is the same as a higher temperature
+            self.leaseoffset = 0.0
+            if cap != None and cap < self.target():
+                self.leaseoffset = self.target() - cap
+            if tempval > ABS_NULL:
+                tempval += self.leaseoffset
+        self.tempval = tempval
+        return tempval
+
+    def handover(self):
+        # Keep the fans running at their current level on exit
+        self.keep = True
+
+    def getstate(self):
+        zonestate = {'mode': self.mode, 'region': self.region, 'lastout': self.lastout, 'controller': None}
+        if self.mode == TEMPCTRL_PI:
+            zonestate['controller'] = self.pid.getstate()
+        elif self.mode == TEMPCTRL_MPC:
+            zonestate['controller'] = self.mpc.getstate()
+        return zonestate
+
+    def resumeState(self):
+        # Continue from the state of a handover, instead of starting from idle
+        if self.resume and self.resume['mode'] == self.mode:
+            self.region = self.resume['region']
+            self.lastout = self.resume['lastout']
+            if self.shaper:
+                self.shaper.clear(self.lastout)
+            if self.mode == TEMPCTRL_PI:
+                self.pid.setstate(self.resume['controller'])
+            elif self.mode == TEMPCTRL_MPC:
+                self.mpc.setstate(self.resume['controller'])
+            self.logi("{}: continuing from handover".format(self.zonename))
+        self.resume = None
+
+    def getprofile(self):
+        # Settings that a profile can switch, only the settings used in this mode
+        return {key: getattr(self, attr) for key, attr in PROFILEKEYS.items() if hasattr(self, attr)}
+
+    def prepareprofile(self, values):
+        # Create what the settings of a profile need, before the control loop is started
+        if not self.load and (values['LoadGain'] > 0 or values['PSIGain'] > 0):
+            self.load = load(self.logger)
+        if not self.shaper and (values['SlewUp'] > 0 or values['SlewDown'] > 0 or values['Dwell'] > 0):
+            self.shaper = shaper()
+            if self.monitor and not self.cpufreq:
+                self.monitor.addmetrics(self)
+
+    def setprofile(self, values):
+        # Switch to the settings of a profile while running, the controllers keep their state
+        self.mutex.acquire()
+        changed = [key for key, value in values.items() if getattr(self, PROFILEKEYS[key]) != value]
+        for key in changed:
+            setattr(self, PROFILEKEYS[key], values[key])
+        if changed:
+            if self.pid:
+                if 'Pgain' in changed or 'Igain' in changed:
+                    if self.igain == 0:
+                        windup = self.fanctrl.max()
+                    else:
+                        windup = self.fanctrl.max()/self.igain
+                    if self.rls:
+                        self.rls.updateGains(Kp = self.pgain, Ki = self.igain)
+                    self.pid.updateGains(Kp = self.pgain, Ki = self.igain, windup = windup)
+                self.pid.updateCommand(self.tempstart)
+            if self.mpc:
+                self.mpc.updateCommand(self.tempstart)
+            if self.linear:
+                self.linear.updateCommand(self.tempstart, self.tempfull)
+            if self.onoff:
+                self.onoff.updateCommand(self.tempon, self.temphyst)
+            if self.shaper:
+                fanrange = (self.fanctrl.max() - self.fanctrl.min()) / 100.0
+                self.shaper.updateRates(slewup = self.slewup * fanrange, slewdown = self.slewdown * fanrange, dwell = self.dwell)
+                if self.quiet:
+                    self.quietcap = self.fanctrl.min() + self.quietmax * fanrange
+        self.mutex.release()
+
+    def clearRegion(self):
+        self.region = REGION_IDLE
+        self.ramping = False
+        self.lastout = 0.0
+
+    def getRegion(self, tempval):
+        # Idle, control or full speed, control is only left for idle below TempStart - TempHyst
+        if tempval > self.tempfull:
+            region = REGION_FULL
+        elif tempval >= self.tempstart:
+            region = REGION_CONTROL
+        elif self.region == REGION_IDLE or tempval < self.tempstart - self.temphyst:
+            region = REGION_IDLE
+        else:
+            region = REGION_CONTROL
+        if region != self.region:
+            self.ramping = True
+        return region
+
+    def idle(self, tempval):
+        # Fan output below TempStart
+        if self.tempon < self.tempstart:
+            return self.onoff.update(tempval)
+        return 0
+
+    def ramp(self, value):
+        # Ramp to the output of a new region, to hand off without steps
+        # a fan below its minimum speed is off, so ramps start at the minimum speed
+        fanmin = self.fanctrl.min()
+        if self.ramping and self.handoff > 0 and value >= fanmin:
+            last = max(self.lastout, fanmin)
+            maxstep = (self.fanctrl.max() - fanmin) / (self.handoff * self.frequency)
+            if self.region == REGION_FULL and value >= last:
+                # above TempFull the fan goes to full speed at once, only the hand off back down is ramped
+                self.ramping = False
+            elif value > last + maxstep:
+                value = last + maxstep
+            elif value < last - maxstep:
+                value = last - maxstep
+            else:
+                self.ramping = False
+        else:
+            self.ramping = False
+        self.lastout = value
+        return value
+
+    def adapt(self):
+        # Estimate the thermal model and adapt the PI gains to it
+        self.rls.update(self.temp.get(), self.fanctrl.get())
+        gains = self.rls.adapt()
+        if gains:
+            Kp, Ki = gains
+            if Ki == 0:
+                windup = self.fanctrl.max()
+            else:
+                windup = self.fanctrl.max()/Ki
+            self.pid.updateGains(Kp = Kp, Ki = Ki, windup = windup)
+            self.logi("{}: PI gains adapted to Kp={:.4g}, Ki={:.4g} (model K={:.4g}, tau={:.3g} s)".format(
+                      self.zonename, Kp, Ki, self.rls.model.gain, self.rls.model.tau))
+
+    def throttle(self):
+        # Adjust the temperature offset to keep the throttled time at zero
+        now = time()
+        events = self.cpufreq.events
+        if self.cpufreq.update():
+            if self.cpufreq.events > events or now - self.throttletime >= THROTTLEHOLD:
+                self.throttletime = now
+                if self.throttleoffset < self.throttlemax:
+                    self.throttleoffset = min(self.throttleoffset + self.throttlestep, self.throttlemax)
+                    self.logw("CPU throttled, temperature offset increased to {:.1f}".format(self.throttleoffset))
+        elif self.throttleoffset > 0 and self.throttletime:
+            self.throttleoffset -= self.throttledecay * (now - self.throttletime) / 3600
+            if self.throttleoffset < 0:
+                self.throttleoffset = 0.0
+            self.throttletime = now
+
+    def enableHeadroom(self):
+        # Keep the headroom estimate up to date, the trend is shared with the predictor if used
+        if self.predict:
+            self.trend = self.predict
+        else:
+            self.trend = predict()
+
+    def headroom(self):
+        # Latest headroom estimate, updated every control loop
+        return self.headroomstr
+
+    def updateHeadroom(self, tempval):
+        # First order thermal model: dT/dt = (Tss - T) / ThermalTau, Tss is estimated from the trend
+        if tempval <= ABS_NULL:
+            self.trend.clear()
+            self.headroomstr = "ERROR no temperature"
+            return
+        if self.trend != self.predict:
+            self.trend.update(tempval)
+        alarmhigh = self.temp.AlarmHigh
+        if alarmhigh == None:
+            alarmhigh = ALARMHIGHDEFAULT
+        degrees = alarmhigh - tempval
+        slope = self.trend.getslope()
+        seconds = -1.0
+        if degrees <= 0:
+            seconds = 0.0
+        elif slope > 0:
+            if self.thermaltau > 0:
+                steadystate = tempval + self.thermaltau * slope
+                if steadystate > alarmhigh:
+                    seconds = -self.thermaltau * log((alarmhigh - steadystate) / (tempval - steadystate))
+            else:
+                seconds = degrees / slope
+        minval = self.fanctrl.min()
+        maxval = self.fanctrl.max()
+        fanval = self.fanctrl.get()
+        capacity = 0.0
+        if maxval > minval:
+            capacity = min(max(100.0 * (maxval - fanval) / (maxval - minval), 0.0), 100.0)
+        cooling = abs(self.thermalgain) * max(maxval - fanval, 0.0)
+        if seconds < 0:
+            secondsstr = "inf"
+        else:
+            secondsstr = "{:.0f}".format(seconds)
+        self.headroomstr = "temp={:.1f} headroom={:.1f} seconds={} fan={:.1f} cooling={:.1f}".format(tempval, degrees,
+                                                                                                     secondsstr, capacity, cooling)
+
+    def enableLeases(self):
+        # Accept boost and temperature target leases from external workloads
+        self.leases = leases()
+
+    def target(self):
+        # Temperature target of the controller
+        if self.mode == TEMPCTRL_ONOFF:
+            return self.tempon
+        return self.tempstart
+
+    def boost(self, level, seconds):
+        # Lease a minimum fan speed, level in % of the fan range or in RPM, e.g. 60, 60% or 2000rpm
+        level = str(level).lower()
+        minval = self.fanctrl.min()
+        maxval = self.fanctrl.max()
+        if level.endswith("rpm"):
+            if not self.fanctrl.rpmmode():
+                raise ValueError("fan is not in RPM mode")
+            value = float(level[:-3])
+        else:
+            value = minval + (maxval - minval) * float(level.rstrip("%")) / 100.0
+        value = min(max(value, minval), maxval)
+        return self.lease(LEASE_BOOST, value, seconds)
+
+    def cap(self, target, seconds):
+        # Lease a maximum temperature target
+        return self.lease(LEASE_CAP, float(target), seconds)
+
+    def lease(self, kind, value, seconds):
+        if not isfinite(seconds) or not 0 < seconds <= LEASEMAXTIME:
+            raise ValueError("invalid time: {}".format(seconds))
+        if not isfinite(value):
+            raise ValueError("invalid {}: {}".format(kind, value))
+        leaseid = self.leases.add(kind, value, seconds)
+        if not leaseid:
+            return "ERROR too many leases"
+        self.logi("{}: lease {}, {} {:.1f} for {:.0f} s".format(self.zonename, leaseid, kind, value, seconds))
+        return "lease={} {}={:.1f} seconds={:.0f}".format(leaseid, kind, value, seconds)
+
+    def release(self, leaseid):
+        if not self.leases.remove(leaseid):
+            return "ERROR unknown lease: {}".format(leaseid)
+        self.logi("{}: lease {} released".format(self.zonename, leaseid))
+        return "OK"
+
+    def getleases(self):
+        active = ["lease={} {}={:.1f} seconds={:.0f}".format(leaseid, kind, value, left)
+                  for leaseid, kind, value, left in self.leases.getall()]
+        return "; ".join(active) or "none"
+
+    def metrics(self):
+        metrics = []
+        if self.cpufreq:
+            metrics += self.cpufreq.metrics() + [("throttle_offset", round(self.throttleoffset, 2))]
+        if self.shaper:
+            metrics += self.shaper.metrics()
+        return metrics
+
+    def getcap(self):
+        # Fan cap in quiet hours, the local time is only checked at the start and end of the quiet hours
+        now = time()
+        if now >= self.quietcheck:
+            clock = localtime(now)
+            minute = clock.tm_hour * 60 + clock.tm_min
+            start, end = self.quiet
+            self.quietactive = self.inperiod(self.quiet, minute)
+            nextchange = min((start - minute) % (24 * 60) or 24 * 60, (end - minute) % (24 * 60) or 24 * 60)
+            self.quietcheck = now + nextchange * 60 - clock.tm_sec
+        if self.quietactive and self.tempval <= self.tempfull:
+            return self.quietcap
+        return None
+
+    def output(self, value):
+        # Fan output with the load feed forward demand added
+        if self.load:
+            utilization, pressure = self.load.update()
+            demand = self.loadgain * max(utilization - self.loadmin, 0) + self.psigain * pressure
+            if demand > 0:
+                minval = self.fanctrl.min()
+                maxval = self.fanctrl.max()
+                if value > 0:
+                    value = min(value + (maxval - minval) * demand / 100.0, maxval)
+                else:
+                    value = minval + (maxval - minval) * min(demand, 100.0) / 100.0
+        if self.leaseboost != None and value < self.leaseboost:
+            value = self.leaseboost
+        if self.temp.rising:
+            # thermal runaway, full speed without limits, shaping continues from full speed
+            value = self.fanctrl.max()
+            if self.shaper:
+                self.shaper.clear(value)
+        elif self.shaper:
+            cap = None
+            if self.quiet:
+                cap = self.getcap()
+            value = self.shaper.update(value, cap)
+        return value
+
+    def feedbacksensors(self):
+        # Sensor temperatures with the throttle and lease offsets of the feedback temperature
+        # the prediction is made for the combined temperature, so it is not added to every sensor
+        offset = self.throttleoffset + self.leaseoffset
+        return [sensor + offset if sensor != None else None for sensor in self.temp.getsensors()]
+
+    def getsensorcurves(self, settings):
+        # Curve, falling curve and weight per sensor, only if at least one sensor has its own curve
+        sensorcurves = []
+        owncurve = False
+        weights = {}
+        weightstr = self.checkkey(settings, 'control', 'CurveWeights')
+        if weightstr != None:
+            for weight in str(weightstr).split(","):
+                if weight.strip():
+                    sensor, value = weight.split(":")
+                    weights[sensor.strip().upper()] = float(value)
+        for sensor in SENSORS:
+            points = self.curvepoints
+            fallpoints = self.curvefallpoints
+            if self.checkkey(settings, 'control', 'Curve' + sensor) != None:
+                owncurve = True
+                points = self.curve.parse(self.checkkey(settings, 'control', 'Curve' + sensor))
+                fallpoints = []
+            if self.checkkey(settings, 'control', 'CurveFall' + sensor) != None:
+                fallpoints = self.curve.parse(self.checkkey(settings, 'control', 'CurveFall' + sensor))
+            weight = 1.0
+            if sensor in weights:
+                weight = weights[sensor]
+            sensorcurves.append((points, fallpoints, weight))
+        if owncurve:
+            self.multicurve = multicurve(len(SENSORS))
+            combine = self.checkkey(settings, 'control', 'CurveCombine')
+            if combine and combine.lower() == "weighted":
+                self.multicurve.updateCombine(COMBINE_WEIGHTED)
+            else:
+                self.multicurve.updateCombine(COMBINE_MAX)
+        return sensorcurves
+
+    def determine(self, interactive = True):
+        # Identify the thermal model by a fan step from minimum to maximum and calculate PI parameters from it
         print("Determining Pgain and Igain")
-        Kp = ((self.fanctrl.max() - self.fanctrl.min()) / (self.tempfull - self.tempstart)) * 0.9
-        Ki = Kp*0.1/(150.0)
-        print("Results: Pgain = {:.3f}, Igain = {:.3f}".format(Kp, Ki))
-        Ok = stdinput.yn_choice("Store results?", "Y")
-        return Ok, round(Kp, 3), round(Ki, 3)
+        Ok = False
+        Kp = 0
+        Ki = 0
+        model = fopdt()
+        sr = self.measurestep()
+        if sr:
+            model.fit(sr[0], sr[1], self.fanctrl.max() - self.fanctrl.min())
+        if model.valid() and model.gain < 0:
+            print("Thermal model: gain = {:.5f} 'C per fan unit, time constant (R*C) = {:.1f} s, dead time = {:.1f} s, residual = {:.2f} 'C".format(
+                  model.gain, model.tau, model.deadtime, model.residual))
+            Kp, Ki = model.tunePI()
+        elif not self.fanctrl.exitevent.is_set():
+            print("No valid thermal model found, using estimated parameters")
+            model.clear()
+            Kp = ((self.fanctrl.max() - self.fanctrl.min()) / (self.tempfull - self.tempstart)) * 0.9
+            Ki = Kp*0.1/(150.0)
+        if not self.fanctrl.exitevent.is_set():
+            print("Results: Pgain = {:.3f}, Igain = {:.5f}".format(Kp, Ki))
+            if interactive:
+                stdinput = stdin("", exitevent = self.fanctrl.exitevent)
+                Ok = stdinput.yn_choice("Store results?", "Y")
+                del stdinput
+            else:
+                Ok = Kp > 0 and Ki > 0
+        thermal = (round(model.gain, 6), round(model.tau, 1), round(model.deadtime, 1))
+        del model
+        return Ok, round(Kp, 3), round(Ki, 5), thermal
+
+    def measurestep(self):
+        tm = []
+        temps = []
+        self.fanctrl.start()
+        print("Settling temperature at minimum fan speed (max. {} s)".format(DTRMN_SETTLE))
+        self.fanctrl.set(self.fanctrl.min())
+        self._settle(DTRMN_SETTLE)
+        if not self.fanctrl.exitevent.is_set():
+            print("Measuring temperature step response at maximum fan speed (max. {} s)".format(DTRMN_LENGTH))
+            self.fanctrl.set(self.fanctrl.max())
+            self._settle(DTRMN_LENGTH, tm, temps)
+        self.fanctrl.set(0)
+        self.fanctrl.stop()
+        if self.fanctrl.exitevent.is_set():
+            return None
+        print("Finished measuring temperature step response")
+        return (tm, temps)
+
+    def _settle(self, maxtime, tm = None, temps = None):
+        # wait until the temperature is steady, optionally record the response
+        window = int(DTRMN_WINDOW/DTRMN_SLEEP)
+        history = []
+        starttime = time()
+        nowtime = starttime
+        while nowtime - starttime <= maxtime and not self.fanctrl.exitevent.is_set():
+            self.temp.update()
+            nowtemp = self.temp.get()
+            if tm != None:
+                tm.append(nowtime - starttime)
+                temps.append(nowtemp)
+            history.append(nowtemp)
+            if len(history) > window:
+                history.pop(0)
+                if max(history) - min(history) < DTRMN_STEADY:
+                    break
+            print("Temp: {}, Fan: {}\r".format(self.temp, self.fanctrl))
+            self.fanctrl.exitevent.wait(DTRMN_SLEEP)
+            nowtime = time()
 
 ######################### MAIN ##########################
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : cpufreq.py                                  #
+#           Detects CPU throttling from:                #
+#           * cpufreq frequencies                       #
+#           * firmware throttling flags (Raspberry Pi)  #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from common.common import common
+from glob import glob
+from time import time
+import os
+#########################################################
+
+####################### GLOBALS #########################
+CPU_FREQ = "/sys/devices/system/cpu/cpu*/cpufreq"
+CUR_FREQ = "scaling_cur_freq"
+MAX_FREQ = "scaling_max_freq"
+HW_MAX_FREQ = "cpuinfo_max_freq"
+THROTTLED = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+THROTTLED_NOW = 0xE # arm frequency capped, throttled, soft temperature limit
+READSIZE = 32
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : cpufreq                                       #
+#########################################################
+class cpufreq(common):
+    def __init__(self, logger = None):
+        self.logger = logger
+        common.__init__(self, self.logger)
+        # files are kept open, every update is a single read per file
+        self.curfds = []
+        self.maxfds = []
+        self.hwmax = 0
+        # scaling_max_freq at startup, a limit set by the user is no throttling
+        self.policymax = []
+        for path in sorted(glob(CPU_FREQ)):
+            curfd = self._open(os.path.join(path, CUR_FREQ))
+            maxfd = self._open(os.path.join(path, MAX_FREQ))
+            if curfd != None and maxfd != None:
+                self.curfds.append(curfd)
+                self.maxfds.append(maxfd)
+                self.policymax.append(self._read(maxfd))
+                hwmaxfd = self._open(os.path.join(path, HW_MAX_FREQ))
+                if hwmaxfd != None:
+                    self.hwmax = max(self.hwmax, self._read(hwmaxfd))
+                    os.close(hwmaxfd)
+        self.throttledfd = self._open(THROTTLED)
+        if not self.curfds and self.throttledfd == None:
+            self.logw("No cpufreq or throttling information available, throttle avoidance not used")
+        self.frequency = 0
+        self.throttled = False
+        self.events = 0
+        self.throttledtime = 0.0
+        self.belowmaxtime = 0.0
+        self.lasttime = 0.0
+
+    def __del__(self):
+        self.exit()
+
+    def __str__(self):
+        return "{:.0f} MHz, {} throttle events".format(self.frequency/1000, self.events)
+
+    def __repr__(self):
+        return "{:.0f}, {}".format(self.frequency/1000, self.events)
+
+    def available(self):
+        return len(self.curfds) > 0 or self.throttledfd != None
+
+    def update(self):
+        # Returns whether the CPU is throttled now, and counts throttle events and time
+        now = time()
+        throttled = False
+        belowmax = False
+        if self.curfds:
+            frequency = 0
+            for i in range(len(self.curfds)):
+                frequency = max(frequency, self._read(self.curfds[i]))
+                # a thermal cooling device lowers the maximum frequency of the policy below its startup value
+                policymax = self._read(self.maxfds[i])
+                if 0 < policymax < self.policymax[i]:
+                    throttled = True
+                elif policymax > self.policymax[i]:
+                    self.policymax[i] = policymax
+            self.frequency = frequency
+            if self.hwmax > 0:
+                belowmax = frequency < self.hwmax
+        if self.throttledfd != None:
+            throttled = (self._read(self.throttledfd, 16) & THROTTLED_NOW) != 0
+        if self.lasttime:
+            if throttled:
+                self.throttledtime += now - self.lasttime
+            if belowmax:
+                self.belowmaxtime += now - self.lasttime
+        if throttled and not self.throttled:
+            self.events += 1
+            self.logw("CPU throttling detected")
+        self.throttled = throttled
+        self.lasttime = now
+        return self.throttled
+
+    def metrics(self):
+        # Throttle statistics as (name, value)
+        return [("cpu_frequency_khz", self.frequency),
+                ("cpu_throttled", int(self.throttled)),
+                ("cpu_throttle_events_total", self.events),
+                ("cpu_throttled_seconds_total", round(self.throttledtime, 1)),
+                ("cpu_below_max_frequency_seconds_total", round(self.belowmaxtime, 1))]
+
+    def exit(self):
+        for fd in self.curfds + self.maxfds:
+            os.close(fd)
+        self.curfds = []
+        self.maxfds = []
+        self.policymax = []
+        if self.throttledfd != None:
+            os.close(self.throttledfd)
+            self.throttledfd = None
+
+    def _open(self, path):
+        fd = None
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except:
+            pass
+        return fd
+
+    def _read(self, fd, base = 10):
+        value = 0
+        try:
+            value = int(os.pread(fd, READSIZE, 0).strip(), base)
+        except:
+            pass
+        return value
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -24,15 +24,15 @@ from hardware.power import power
 # Class : fanoutput                                     #
 #########################################################
 class fanoutput(common):
-    def __init__(self, piio, settings):
+    def __init__(self, piio, settings, level = 0):
+        # level is the initial output, e.g. to continue at the level of a handover
         mode = self.checkkey(settings, 'fan', 'mode')
+        self.pwm = None
         if mode:
             if mode.lower() != 'onoff':
-                self.pwm = pwm(piio, settings)
-            else:
-                self.pwm = None
-        self.power = power(piio, settings)
-        self.ispowered = False
+                self.pwm = pwm(piio, settings, level)
+        self.ispowered = level > 0
+        self.power = power(piio, settings, self.ispowered)
 
     def __del__(self):
         del self.power
@@ -72,7 +72,8 @@ class fanoutput(common):
     
     def exit(self):
         self.power.exit()
-        self.pwm.exit()
+        if self.pwm:
+            self.pwm.exit()
 
 ######################### MAIN ##########################
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : load.py                                     #
+#           Measures the CPU load from:                 #
+#           * CPU utilization (/proc/stat)              #
+#           * CPU pressure stall information (PSI)      #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+from common.common import common
+from time import time
+import os
+#########################################################
+
+####################### GLOBALS #########################
+CPU_STAT = "/proc/stat"
+CPU_PRESSURE = "/proc/pressure/cpu"
+READSIZE = 256 # only the first line is used
+STAT_IDLE = 3
+STAT_IOWAIT = 4
+USPS = 1000000.0 # micro seconds per second
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+
+#########################################################
+# Class : load                                          #
+#########################################################
+class load(common):
+    def __init__(self, logger = None):
+        self.logger = logger
+        common.__init__(self, self.logger)
+        # files are kept open, every update is a single read without open/ close
+        self.statfd = self._open(CPU_STAT)
+        self.psifd = self._open(CPU_PRESSURE)
+        self.utilization = 0.0
+        self.pressure = 0.0
+        self.lastbusy = 0
+        self.lasttotal = 0
+        self.laststall = 0
+        self.lasttime = 0.0
+        self.update()
+
+    def __del__(self):
+        self.exit()
+
+    def __str__(self):
+        return "{:.1f}% load, {:.1f}% pressure".format(self.utilization, self.pressure)
+
+    def __repr__(self):
+        return "{:.1f}, {:.1f}".format(self.utilization, self.pressure)
+
+    def update(self):
+        # Utilization and pressure in % since the previous update
+        if self.statfd != None:
+            try:
+                fields = os.pread(self.statfd, READSIZE, 0).split(b"\n", 1)[0].split()[1:]
+                values = [int(field) for field in fields]
+                total = sum(values)
+                busy = total - values[STAT_IDLE] - values[STAT_IOWAIT]
+                if self.lasttotal and total > self.lasttotal:
+                    self.utilization = 100.0 * (busy - self.lastbusy) / (total - self.lasttotal)
+                self.lastbusy = busy
+                self.lasttotal = total
+            except:
+                self.utilization = 0.0
+        if self.psifd != None:
+            try:
+                now = time()
+                some = os.pread(self.psifd, READSIZE, 0).split(b"\n", 1)[0]
+                stall = int(some.rsplit(b"total=", 1)[1])
+                if self.lasttime and now > self.lasttime:
+                    self.pressure = 100.0 * (stall - self.laststall) / ((now - self.lasttime) * USPS)
+                    if self.pressure > 100.0:
+                        self.pressure = 100.0
+                self.laststall = stall
+                self.lasttime = now
+            except:
+                self.pressure = 0.0
+        return self.utilization, self.pressure
+
+    def get(self):
+        return self.utilization, self.pressure
+
+    def exit(self):
+        if self.statfd != None:
+            os.close(self.statfd)
+            self.statfd = None
+        if self.psifd != None:
+            os.close(self.psifd)
+            self.psifd = None
+
+    def _open(self, path):
+        fd = None
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except:
+            self.logw("{} not available, not used for load feed forward".format(path))
+        return fd
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    pass
@@ -31,14 +31,17 @@ DEFOFF    = "OFF"
 # Class : power                                         #
 #########################################################
 class power(common):
-    def __init__(self, piio, settings):
+    def __init__(self, piio, settings, on = False):
         self.piio = piio
         self.gpio = self.checkkeydef(settings, 'fan', 'ONOFFgpio', DEFGPIO)
         self.invert = self.checkkeydef(settings, 'fan', 'ONOFFinvert', DEFINVERT)
         
         if ifinstalled and self.piio:
             self.piio.set_mode(self.gpio,pigpio.OUTPUT)
-            self.piio.write(self.gpio, 0)
+            if on:
+                self.set(True)
+            else:
+                self.piio.write(self.gpio, 0)
 
     def __del__(self):
         pass
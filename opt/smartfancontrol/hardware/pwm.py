@@ -32,7 +32,7 @@ DEFINVERT = False
 # Class : pwm                                           #
 #########################################################
 class pwm(common):
-    def __init__(self, piio, settings):
+    def __init__(self, piio, settings, level = 0):
         self.piio = piio
         self.gpio = self.checkkeydef(settings, 'fan', 'PWMgpio', DEFGPIO)
         self.frequency = self.checkkeydef(settings, 'fan', 'PWMfrequency', DEFFREQ)
@@ -41,7 +41,7 @@ class pwm(common):
         
         if ifinstalled and self.piio:
             self.piio.set_mode(self.gpio,pigpio.ALT5)
-            self.set(0)
+            self.set(level)
             #self.piio.write(self.gpio, 0)
 
     def __del__(self):
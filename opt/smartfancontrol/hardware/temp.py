@@ -11,6 +11,7 @@
 
 ####################### IMPORTS #########################
 from common.common import common
+from control.predict import predict
 from subprocess import Popen, PIPE
 #########################################################
 
@@ -30,6 +31,10 @@ DEF_SHUTDOWN = ["shutdown", "-h", "now"]
 
 MONITOR_SLEEP = 1
 
+RISEWINDOWDEFAULT = 10 # seconds
+RISEHYST = 0.5 # the rise alarm is reset below this part of AlarmRise
+FREQDEFAULT = 1
+
 ABS_NULL = -273.15
 
 #########################################################
@@ -58,6 +63,10 @@ ABS_NULL = -273.15
             If Farenheit is selected, then this temperature is in Farenheit.
 <AlarmShutdown> Will the system shutdown at critical temperature. Default is true.
                 Alternatively a file/scriptname can be entered here to execute when this alarm occurs.
+<AlarmRise> Temperature rise in degrees per second to rise a temperature rising alarm, e.g. on a failed heatsink
+            or a seized fan. The fan runs at full speed while this alarm is active. Default is 0 (not used).
+<AlarmRiseWindow> Time in seconds the temperature rise is averaged over. Default is 10.
+<AlarmRiseHook> File/scriptname to execute when the temperature rising alarm occurs. Default is empty.
 """
 
 class temp(common):
@@ -92,11 +101,23 @@ class temp(common):
                 self.AlarmShutdown = DEF_SHUTDOWN
         else:
             self.AlarmShutdown = None
+        self.AlarmRise = self.checkkeydef(settings,'temp','AlarmRise', 0)
+        self.AlarmRiseHook = None
+        if self.checkkey(settings,'temp','AlarmRiseHook'):
+            self.AlarmRiseHook = str(self.checkkey(settings,'temp','AlarmRiseHook')).split()
+        self.rise = None
+        self.rising = False
+        if self.AlarmRise > 0:
+            # the rise is the slope of a linear regression over the window, this filters sensor noise
+            self.rise = predict()
+            self.rise.updateSettings(frequency = self.checkkeydef(settings,'control','Frequency', FREQDEFAULT),
+                                     window = self.checkkeydef(settings,'temp','AlarmRiseWindow', RISEWINDOWDEFAULT))
         self.temperature = None
+        self.sensors = [None, None, None]
         self.curalarm = ALARM_NONE
 
     def __del__(self):
-        pass
+        del self.rise
     
     def __str__(self):
         return self.print(self.temperature)
@@ -134,6 +155,9 @@ class temp(common):
         tEXT = self.GetEXTTemp()
         if tEXT:
             Temp.append(tEXT)
+        self.sensors[0] = tCPU
+        self.sensors[1] = tHDD
+        self.sensors[2] = tEXT
         if len(Temp) > 0:
             if self.mode == MODE_MIN:
                 self.temperature = min(Temp)   
@@ -144,7 +168,10 @@ class temp(common):
         else:
             self.temperature = None
         
-        return self.temperature, self.getalarm(), tCPU, tHDD, tEXT
+        alarm = self.getalarm()
+        if self.rise and self.getrise() and alarm != self.alarm.ALARM_TEMPCRIT:
+            alarm = self.alarm.ALARM_TEMPRISE
+        return self.temperature, alarm, tCPU, tHDD, tEXT
     
     def get(self):
         if self.temperature:
@@ -152,6 +179,10 @@ class temp(common):
         else:
             return ABS_NULL
     
+    def getsensors(self):
+        # CPU, HDD and EXT temperature, None if not used or not available
+        return self.sensors
+
     def monitor(self, exitevent):
         print("Monitoring temperature")
         while not exitevent.is_set():
@@ -194,6 +225,33 @@ class temp(common):
             self.alarm.reset(self.alarm.ALARM_TEMPCRIT)
             return self.alarm.ALARM_NONE
     
+    def getrise(self):
+        # Temperature rising alarm from the filtered temperature rise, independent of the temperature alarms
+        if self.temperature == None:
+            self.rise.clear()
+            slope = 0.0
+        else:
+            self.rise.update(self.temperature)
+            slope = self.rise.getslope()
+            # only a full window is filtered enough
+            if self.rise.count < self.rise.size:
+                slope = 0.0
+        if slope >= self.AlarmRise:
+            if not self.rising:
+                self.rising = True
+                self.alarm.set(self.alarm.ALARM_TEMPRISE)
+                self.loge("{} ({:.2f} degrees per second)".format(self.alarm, slope))
+                if self.AlarmRiseHook:
+                    try:
+                        Popen(self.AlarmRiseHook)
+                    except:
+                        self.loge("Executing temperature rising alarm hook failed")
+        elif self.rising and slope < self.AlarmRise * RISEHYST:
+            self.rising = False
+            self.alarm.reset(self.alarm.ALARM_TEMPRISE)
+            self.logi("Temperature rise back to normal")
+        return self.rising
+    
     def GetCPUTemp(self):
         if self.cpu:
             try:
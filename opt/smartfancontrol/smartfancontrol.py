@@ -23,14 +23,20 @@ from getopt import getopt, GetoptError
 import logging
 import logging.handlers
 import locale
+from time import time
 from threading import Lock, Event
 from common.common import common
 from common.alarm import alarm
+from common.state import state
+from common.server import server
 from hardware.fanoutput import fanoutput
+from hardware.power import power
 from hardware.rpm import rpm
 from hardware.temp import temp
 from engine.fanctrl import fanctrl
+from engine.fanbank import fanbank, parsefans
 from engine.tempctrl import tempctrl
+from engine.profiles import profiles, hasprofiles
 #########################################################
 
 ####################### GLOBALS #########################
@@ -39,12 +45,17 @@ XML_FILENAME     = "smartfancontrol.xml"
 LOG_FILENAME     = "smartfancontrol.log"
 LOG_MAXSIZE      = 100*1024*1024
 ENCODING         = 'utf-8'
+HANDOVERSTATE    = "handover"
+HANDOVERMAXAGE   = 60 # seconds
+JOINTIMEOUT      = 5  # seconds
 MODE_RUN         = 0
 MODE_MANUALCAL   = 1
 MODE_TEMP        = 2
 MODE_FAN         = 3
 MODE_AUTOTUNEFAN = 4
 MODE_DETERMINE   = 5
+MODE_CURVECAL    = 6
+MODE_STARTCAL    = 7
 #########################################################
 
 ###################### FUNCTIONS ########################
@@ -55,9 +66,12 @@ MODE_DETERMINE   = 5
 class SmartFanControl(common):
     def __init__(self):
         signal.signal(signal.SIGINT, self.exit_app)
-        signal.signal(signal.SIGTERM, self.exit_app)
+        signal.signal(signal.SIGTERM, self.handover_app)
+        signal.signal(signal.SIGUSR1, self.recalibrate_app)
         self.exitevent = Event()
         self.exitevent.clear()
+        self.handover = False
+        self.running = False
         self.logger = logging.getLogger('smartfancontrol')
         self.logger.setLevel(logging.INFO)
         # create file handler which logs even debug messages
@@ -76,6 +90,7 @@ class SmartFanControl(common):
         self.alarm = alarm()
 
         common.__init__(self, self.logger)
+        self.state = state(self.logger)
 
         self.pi = None
         if ifinstalled:
@@ -86,87 +101,243 @@ class SmartFanControl(common):
         self.temp = None
         self.fanctrl = None
         self.tempctrl = None
+        self.fanbank = None
+        self.server = None
+        self.profiles = None
+        self.fanoutputs = []
+        self.rpms = []
+        self.fanctrls = []
+        self.temps = []
+        self.tempctrls = []
 
     def __del__(self):
+        del self.profiles
         del self.tempctrl
         del self.fanctrl
         del self.temp
         del self.rpm
         del self.fanoutput
+        del self.tempctrls
+        del self.fanbank
+        del self.fanctrls
+        del self.temps
+        del self.rpms
+        del self.fanoutputs
         del self.alarm
+        del self.state
         if ifinstalled:
             self.pi.stop()
             del self.pi
         logging.shutdown()
 
     def run(self, argv):
-        mode, monstatus = self.parseopts(argv)
+        mode, monstatus, interactive = self.parseopts(argv)
         self.GetXML()
-        if mode == MODE_MANUALCAL or mode == MODE_TEMP: # no auto calibration
+        if mode == MODE_MANUALCAL or mode == MODE_TEMP or mode == MODE_CURVECAL or mode == MODE_STARTCAL: # no auto calibration
             autocalibrate = False
         else:
             autocalibrate = True
-        self.fanoutput = fanoutput(self.pi, self.settings)
-        self.rpm = rpm(self.pi, self.settings)
-        self.temp = temp(self.settings, self.alarm, self.logger)
-        self.fanctrl = fanctrl(self.rpm, self.fanoutput, self.mutex, self.settings, self.alarm, self.logger, self.exitevent, autocalibrate)
-        self.tempctrl = tempctrl(self.fanctrl, self.temp, self.settings, self.alarm, self.logger, self.exitevent, monstatus)
+        nfans = self.countGroups('fan')
+        nzones = self.countGroups('temp', 'control')
+        resume = None
+        if mode == MODE_RUN:
+            resume = self.loadHandover(nfans, nzones)
+        zonesettings = []
+        mappings = []
+        for zone in range(1, nzones+1):
+            settings = self.getGroupSettings(zone, 'temp', 'control')
+            zonesettings.append(settings)
+            if zone == 1:
+                self.temps.append(temp(settings, self.alarm, self.logger))
+            else:
+                self.temps.append(temp(settings, alarm(), self.logger))
+            try:
+                mappings.append(parsefans(self.checkkey(settings, 'control', 'Fans'), nfans))
+            except ValueError:
+                self.logger.error("Invalid fans for zone {}, using all fans".format(zone))
+                mappings.append(parsefans(None, nfans))
+        for fan in range(1, nfans+1):
+            settings = self.getGroupSettings(fan, 'fan')
+            fanresume = None
+            level = 0
+            if resume:
+                fanresume = resume['fans'][fan-1]
+                level = fanresume['output']
+            self.fanoutputs.append(fanoutput(self.pi, settings, level))
+            self.rpms.append(rpm(self.pi, settings))
+            if fan == 1:
+                fanalarm = self.alarm
+                mutex = self.mutex
+            else:
+                fanalarm = alarm()
+                mutex = Lock()
+            self.fanctrls.append(fanctrl(self.rpms[-1], self.fanoutputs[-1], mutex, settings, fanalarm, self.logger, self.exitevent,
+                                         autocalibrate, self.state, self.temps[0], threaded = False, fanid = fan, resume = fanresume))
+        backup = None
+        if self.checkkey(self.settings, 'fan', 'FailoverGpio') != None:
+            # ON/ OFF backup fan, switched on when a fan stalls
+            backup = power(self.pi, {'fan': {'ONOFFgpio': self.settings['fan']['FailoverGpio'],
+                                             'ONOFFinvert': self.checkkey(self.settings, 'fan', 'FailoverInvert')}})
+        self.fanbank = fanbank(self.fanctrls, mappings, self.settings, self.logger, self.exitevent, backup)
+        for zone in range(1, nzones+1):
+            if zone == 1:
+                zonealarm = self.alarm
+            else:
+                zonealarm = self.temps[zone-1].alarm
+            zoneresume = None
+            if resume:
+                zoneresume = resume['zones'][zone-1]
+            self.tempctrls.append(tempctrl(self.fanbank.zone(zone-1), self.temps[zone-1], zonesettings[zone-1], zonealarm,
+                                           self.logger, self.exitevent, monstatus, zone, zoneresume))
+        # calibration, tuning and testing modes use the first fan and zone
+        self.fanoutput = self.fanoutputs[0]
+        self.rpm = self.rpms[0]
+        self.temp = self.temps[0]
+        self.fanctrl = self.fanctrls[0]
+        self.tempctrl = self.tempctrls[0]
 
         if mode == MODE_MANUALCAL:
             self.settings['fan']['PWMcalibrated'] = self.fanctrl.manualCalibrate()
             self.updateXML()
-            self.fanctrl.exit()
-            self.fanoutput.exit()
+            self.exitFans()
             exit(2)
+        elif mode == MODE_STARTCAL:
+            startpwm, stallpwm = self.fanctrl.startCalibrate()
+            if startpwm > 0:
+                self.settings['fan']['PWMstart'] = startpwm
+                self.settings['fan']['PWMcalibrated'] = stallpwm
+                self.updateXML()
+            self.exitFans()
+            exit(7)
+        elif mode == MODE_CURVECAL:
+            self.fanctrl.curveCalibrate()
+            self.exitFans()
+            exit(6)
         elif mode == MODE_TEMP:
             self.temp.monitor(self.exitevent)
-            self.fanctrl.exit()
-            self.fanoutput.exit()
+            self.exitFans()
             exit(3)
         elif mode == MODE_FAN:
             self.fanctrl.start()
             self.fanctrl.manual()
-            self.fanctrl.exit()
-            self.fanoutput.exit()
+            self.exitFans()
             exit(4)
         elif mode == MODE_AUTOTUNEFAN:
             #self.fanctrl.start()
-            Ok, Kp, Ki = self.fanctrl.RPMautotune()
+            Ok, Kp, Ki = self.fanctrl.RPMautotune(interactive)
             if Ok:
                 self.settings['fan']['Pgain'] = Kp
                 self.settings['fan']['Igain'] = Ki
                 self.updateXML()
-            self.fanctrl.exit()
-            self.fanoutput.exit()
+            self.exitFans()
             exit(5)
         elif mode == MODE_DETERMINE:
-            Ok, Kp, Ki = self.tempctrl.determine()
+            Ok, Kp, Ki, thermal = self.tempctrl.determine(interactive)
             if Ok:
                 self.settings['control']['Pgain'] = Kp
                 self.settings['control']['Igain'] = Ki
+                self.settings['control']['ThermalGain'] = thermal[0]
+                self.settings['control']['ThermalTau'] = thermal[1]
+                self.settings['control']['ThermalDead'] = thermal[2]
                 self.updateXML()
-            self.fanctrl.exit()
-            self.fanoutput.exit()
+            self.exitFans()
             exit(5)
 
         self.logger.info("Starting SmartFanControl")
 
+        if hasprofiles(self.settings) and not self.exitevent.is_set():
+            self.profiles = profiles(self.settings, self.tempctrls, self.fanctrls, self.alarm, self.logger, self.exitevent)
+
+        if self.checkkey(self.settings, 'control', 'Socket') and not self.exitevent.is_set():
+            self.server = server(self.settings['control']['Socket'], self.logger, self.exitevent)
+            for zonectrl in self.tempctrls:
+                zonectrl.enableHeadroom()
+                zonectrl.enableLeases()
+            self.server.register("headroom", self.headroom_cmd)
+            self.server.register("boost", self.boost_cmd)
+            self.server.register("cap", self.cap_cmd)
+            self.server.register("leases", self.leases_cmd)
+            self.server.register("release", self.release_cmd)
+            if self.profiles:
+                self.server.register("profile", self.profiles.profile_cmd)
+
         if not self.exitevent.is_set():
-            self.fanctrl.start()
-            self.tempctrl.start()
+            self.running = True
+            self.fanbank.start()
+            for zonectrl in self.tempctrls:
+                zonectrl.start()
             signal.pause()
 
         self.logger.info("SmartFanControl Ready")
-        self.tempctrl.exit()
-        self.fanctrl.exit()
-        self.fanoutput.exit()
+        for zonectrl in self.tempctrls:
+            zonectrl.exit()
+        if self.handover:
+            self.saveHandover()
+        self.exitFans()
+
+    def exitFans(self):
+        self.fanbank.exit()
+        if not self.handover:
+            for output in self.fanoutputs:
+                output.exit()
+
+    def loadHandover(self, nfans, nzones):
+        # State of a handover by the previous instance, only used once and if recent
+        handover = self.state.get(HANDOVERSTATE)
+        if not handover:
+            return None
+        self.state.reset(HANDOVERSTATE)
+        try:
+            age = time() - handover['timestamp']
+            if age < 0 or age >= HANDOVERMAXAGE:
+                self.logger.info("Handover state is outdated, starting without handover")
+                return None
+            if len(handover['fans']) != nfans or len(handover['zones']) != nzones:
+                self.logger.info("Fans or zones changed, starting without handover")
+                return None
+        except:
+            self.logger.warning("Invalid handover state, starting without handover")
+            return None
+        self.logger.info("Continuing from handover")
+        return handover
+
+    def saveHandover(self):
+        # Wait for the control loops to finish and store their state, the fans keep running
+        for zonectrl in self.tempctrls:
+            zonectrl.join(JOINTIMEOUT)
+        self.fanbank.join(JOINTIMEOUT)
+        self.state.set(HANDOVERSTATE, {'timestamp': time(), 'fans': self.fanbank.getstate(),
+                                       'zones': [zonectrl.getstate() for zonectrl in self.tempctrls]})
+        self.logger.info("Handover state stored, fans keep running")
+
+    def countGroups(self, *groups):
+        # Additional fans or zones are entered as <group>2, <group>3, ...
+        count = 1
+        while any("{}{}".format(group, count+1) in self.settings for group in groups):
+            count += 1
+        return count
+
+    def getGroupSettings(self, index, *groups):
+        # Settings of an additional fan or zone, settings not entered in <group>index are taken from <group>
+        if index <= 1:
+            return self.settings
+        settings = dict(self.settings)
+        for group in groups:
+            settings[group] = {}
+            if group in self.settings:
+                settings[group].update(self.settings[group])
+            groupindex = "{}{}".format(group, index)
+            if groupindex in self.settings:
+                settings[group].update(self.settings[groupindex])
+        return settings
 
     def parseopts(self, argv):
         mode = MODE_RUN
         monstatus = False
+        interactive = True
         self.title()
         try:
-            opts, args = getopt(argv,"hvctfadm,",["help","version","cal","temp","fan","auto","dtrmn","mon"])
+            opts, args = getopt(argv,"hvcsrtfadmn,",["help","version","cal","start","rpmcurve","temp","fan","auto","dtrmn","mon","non-interactive"])
         except GetoptError:
             print("Enter 'smartfancontrol -h' for help")
             exit(2)
@@ -177,11 +348,14 @@ class SmartFanControl(common):
                 print("         -h, --help   : this help file")
                 print("         -v, --version: print version information")
                 print("         -c, --cal    : manually calibrate PWM level and exit")
+                print("         -s, --start  : automatically calibrate start and minimum running PWM level and exit (RPM control)")
+                print("         -r, --rpmcurve: calibrate PWM to RPM characteristic and exit (RPM control)")
                 print("         -t, --temp   : Monitor temperature(s)")
                 print("         -f, --fan    : Set fan PWM or RPM for testing")
                 print("         -a, --auto   : Autotune fan PI controller (RPM control)")
                 print("         -d, --dtrmn  : Determine temperature PI controller optimum parameters")
                 print("         -m, --mon    : Monitor actual status in terminal")
+                print("         -n, --non-interactive: Do not ask for input, store results if valid (with -a or -d)")
                 print("         <no argument>: run as daemon")
                 exit()
             elif opt in ("-v", "--version"):
@@ -189,6 +363,10 @@ class SmartFanControl(common):
                 exit()
             elif opt in ("-c", "--cal"):
                 mode = MODE_MANUALCAL
+            elif opt in ("-s", "--start"):
+                mode = MODE_STARTCAL
+            elif opt in ("-r", "--rpmcurve"):
+                mode = MODE_CURVECAL
             elif opt in ("-t", "--temp"):
                 mode = MODE_TEMP
             elif opt in ("-f", "--fan"):
@@ -199,7 +377,9 @@ class SmartFanControl(common):
                 mode = MODE_DETERMINE
             elif opt in ("-m", "--mon"):
                 monstatus = True
-        return mode, monstatus
+            elif opt in ("-n", "--non-interactive"):
+                interactive = False
+        return mode, monstatus, interactive
 
     def GetXML(self):
         XMLpath = self.getXMLpath()
@@ -305,8 +485,51 @@ class SmartFanControl(common):
                 exit(1)
         return (LoggerPath)
 
+    def getzone(self, args):
+        # Temperature control of the zone argument of a command, default is zone 1
+        zone = 1
+        if args:
+            zone = int(args[0])
+        if zone < 1 or zone > len(self.tempctrls):
+            raise ValueError("invalid zone: {}".format(zone))
+        return self.tempctrls[zone-1]
+
+    def headroom_cmd(self, args):
+        return self.getzone(args).headroom()
+
+    def boost_cmd(self, args):
+        if len(args) < 2:
+            return "ERROR usage: boost <level>[%|rpm] <seconds> [zone]"
+        return self.getzone(args[2:]).boost(args[0], float(args[1]))
+
+    def cap_cmd(self, args):
+        if len(args) < 2:
+            return "ERROR usage: cap <temperature> <seconds> [zone]"
+        return self.getzone(args[2:]).cap(args[0], float(args[1]))
+
+    def leases_cmd(self, args):
+        return self.getzone(args).getleases()
+
+    def release_cmd(self, args):
+        if len(args) < 1:
+            return "ERROR usage: release <lease> [zone]"
+        return self.getzone(args[1:]).release(int(args[0]))
+
     def exit_app(self, signum, frame):
         self.exitevent.set()
+
+    def handover_app(self, signum, frame):
+        # SIGTERM hands over to the next instance if enabled, otherwise it exits like SIGINT
+        if self.checkkey(self.settings, 'control', 'Handover') and self.running:
+            self.handover = True
+            self.fanbank.handover()
+            for zonectrl in self.tempctrls:
+                zonectrl.handover()
+        self.exitevent.set()
+
+    def recalibrate_app(self, signum, frame):
+        if self.fanbank:
+            self.fanbank.recalibrate()
 #########################################################
 
 ######################### MAIN ##########################
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : bench_pid.py                                #
+#           Benchmarks an update of pid and pid2        #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import sys
+from timeit import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "opt", "smartfancontrol"))
+from control.pid import pid
+from control.pid2 import pid2
+#########################################################
+
+####################### GLOBALS #########################
+UPDATES = 100000
+#########################################################
+
+###################### FUNCTIONS ########################
+
+def bench(controller, **kwargs):
+    # Time per update, every update is computed (one sample time later than the previous one)
+    controller.updateSettings(Kp = 1.0, Ki = 0.1, frequency = 1.0, setpoint = 50.0, **kwargs)
+    controller.last_time = 0.0
+    clock = [0.0]
+    def update():
+        clock[0] += 1.0
+        controller.update(45.0 + (clock[0] % 10), clock[0])
+    return timeit(update, number = UPDATES) / UPDATES
+
+#########################################################
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    print("pid                     : {:.2f} us/update".format(bench(pid()) * 1e6))
+    print("pid2                    : {:.2f} us/update".format(bench(pid2()) * 1e6))
+    print("pid2 weight, D, slew    : {:.2f} us/update".format(bench(pid2(), Kd = 2.0, weight = 0.5, slew = 5.0) * 1e6))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : test_pid2.py                                #
+#           Step response regression tests of pid2      #
+#           against pid                                 #
+#           I. Helwegen 2020                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "opt", "smartfancontrol"))
+from control.pid import pid
+from control.pid2 import pid2
+#########################################################
+
+####################### GLOBALS #########################
+PLANT_GAIN = 2.0
+PLANT_TAU  = 20.0
+STEPTIME   = 1.0
+STEPS      = 300
+#########################################################
+
+###################### FUNCTIONS ########################
+
+def simulate(controller, setpoint = 1.0, steps = STEPS):
+    # Closed loop step response of a first order plant, the controller is updated every STEPTIME
+    controller.last_time = 0.0
+    controller.updateCommand(setpoint)
+    y = 0.0
+    outputs = []
+    for step in range(1, steps + 1):
+        u = controller.update(y, step * STEPTIME)
+        y += (PLANT_GAIN * u - y) * STEPTIME / PLANT_TAU
+        outputs.append((u, y))
+    return outputs
+
+def pidcontroller(Kp, Ki):
+    controller = pid()
+    controller.updateSettings(Kp = Kp, Ki = Ki, Kd = 0.0, frequency = 1 / STEPTIME, outputmin = -1000.0,
+                              outputmax = 1000.0, windup = 1e6, setpoint = 0.0)
+    return controller
+
+def pid2controller(Kp, Ki, weight = 1.0, Kd = 0.0):
+    controller = pid2()
+    controller.updateSettings(Kp = Kp, Ki = Ki, Kd = Kd, frequency = 1 / STEPTIME, outputmin = -1000.0,
+                              outputmax = 1000.0, setpoint = 0.0, weight = weight)
+    return controller
+
+#########################################################
+
+#########################################################
+# Class : testpid2                                      #
+#########################################################
+class testpid2(unittest.TestCase):
+    def test_matches_pid(self):
+        # Without setpoint weighting, derivative and limits pid2 is the same PI controller as pid
+        for Kp, Ki in ((1.0, 0.1), (0.5, 0.02), (3.0, 0.0)):
+            expected = simulate(pidcontroller(Kp, Ki))
+            actual = simulate(pid2controller(Kp, Ki))
+            for (u1, y1), (u2, y2) in zip(expected, actual):
+                self.assertAlmostEqual(u1, u2, places = 9)
+                self.assertAlmostEqual(y1, y2, places = 9)
+
+    def test_setpoint_weight(self):
+        # A setpoint weight of 0.5 halves the P step on a setpoint change, the I part is the same
+        full = simulate(pid2controller(1.0, 0.1, weight = 1.0), steps = 1)
+        half = simulate(pid2controller(1.0, 0.1, weight = 0.5), steps = 1)
+        self.assertLess(half[0][0], full[0][0])
+        self.assertAlmostEqual(full[0][0] - half[0][0], 0.5, places = 9)
+
+    def test_setpoint_weight_settles(self):
+        # The integral part removes the steady state error for any setpoint weight
+        for weight in (1.0, 0.5, 0.0):
+            u, y = simulate(pid2controller(1.0, 0.1, weight = weight), steps = 2000)[-1]
+            self.assertAlmostEqual(y, 1.0, places = 3)
+
+    def test_limits(self):
+        # Back calculation keeps the output within its limits and the integral does not wind up
+        controller = pid2()
+        controller.updateSettings(Kp = 1.0, Ki = 0.1, frequency = 1 / STEPTIME, outputmin = 0.0, outputmax = 0.6,
+                                  setpoint = 0.0)
+        for u, y in simulate(controller, steps = 1000):
+            self.assertTrue(0.0 <= u <= 0.6)
+        self.assertLess(controller.ITerm, 10.0)
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    unittest.main()